@@ -1,4 +1,8 @@
+import copy
+import dataclasses
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
 import os
 import sys
@@ -12,12 +16,58 @@ from mmaudio.eval_utils import (
 from mmaudio.model.flow_matching import FlowMatching
 from mmaudio.model.networks import MMAudio, get_my_mmaudio
 from mmaudio.model.utils.features_utils import FeaturesUtils
+from mmaudio.model.sequence_config import SequenceConfig
 from utils import LOUDNESS_NORM
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
 
 log = logging.getLogger()
 
+
+@dataclasses.dataclass(frozen=True)
+class DurationConfig:
+    """某一时长下的不可变序列配置：seq_cfg 副本 + 拥有独立序列长度与 RoPE 缓冲区的网络视图。"""
+    seq_cfg: SequenceConfig
+    net: MMAudio
+
+
+class DurationConfigCache:
+    """
+    按时长缓存 MMAudio 的序列配置，取代对全局 seq_cfg / net 的原地修改。
+
+    net 视图是浅拷贝：参数与子模块与原网络共享，只有 _latent_seq_len 等长度字段和
+    latent_rot / clip_rot 旋转位置编码属于视图自身。序列长度相同的时长共用同一视图，
+    不同时长的请求可以并发执行而互不干扰。
+    """
+
+    def __init__(self, seq_cfg: SequenceConfig, net: MMAudio, max_entries: int = 32):
+        self.seq_cfg = seq_cfg
+        self.net = net
+        self.max_entries = max_entries
+        self._views = OrderedDict()  # (latent, clip, sync) seq len -> net 视图
+        self._lock = threading.Lock()
+
+    def _make_view(self, seq_cfg: SequenceConfig) -> MMAudio:
+        view = copy.copy(self.net)
+        view._buffers = dict(self.net._buffers)  # RoPE 缓冲区归视图所有
+        view.update_seq_lengths(seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
+        return view
+
+    def get(self, duration: float) -> DurationConfig:
+        seq_cfg = dataclasses.replace(self.seq_cfg, duration=duration)
+        bucket = (seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
+        with self._lock:
+            view = self._views.get(bucket)
+            if view is None:
+                view = self._make_view(seq_cfg)
+                self._views[bucket] = view
+                while len(self._views) > self.max_entries:
+                    self._views.popitem(last=False)
+            else:
+                self._views.move_to_end(bucket)
+        return DurationConfig(seq_cfg=seq_cfg, net=view)
+
+
 def load_mmaudio_model(variant='large_44k_v2', full_precision=False):
     if variant not in all_model_cfg:
         raise ValueError(f'Unknown model variant: {variant}')
@@ -45,6 +95,7 @@ def load_mmaudio_model(variant='large_44k_v2', full_precision=False):
         'model_cfg': model,
         'seq_cfg': seq_cfg,
         'net': net,
+        'duration_configs': DurationConfigCache(seq_cfg, net),
         'feature_utils': feature_utils,
         'device': device,
         'dtype': dtype
@@ -52,7 +103,7 @@ def load_mmaudio_model(variant='large_44k_v2', full_precision=False):
 
 
 @torch.inference_mode()
-def audio(
+def render_audio(
     prompt: str,
     negative_prompt: str,
     model_bundle: dict,
@@ -60,18 +111,16 @@ def audio(
     cfg_strength: float = 4.5,
     num_steps: int = 100,
     seed: int = 42,
-    output_path: Path = Path('./output/out.wav'),
     normalize: bool = True,
     volume: float = -23.0,
     peak_norm_db_for_norm: float = -1.0,
 ):
+    """生成并归一化音频，返回 (waveform (channels, samples) float32, sampling_rate)。"""
     setup_eval_logging()
 
-    output_path = Path(output_path).expanduser()
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-
-    seq_cfg = model_bundle['seq_cfg']
-    net = model_bundle['net']
+    duration_cfg = model_bundle['duration_configs'].get(duration)
+    seq_cfg = duration_cfg.seq_cfg
+    net = duration_cfg.net
     feature_utils = model_bundle['feature_utils']
     device = model_bundle['device']
 
@@ -81,8 +130,6 @@ def audio(
 
     # 无视频模式
     clip_frames = sync_frames = None
-    seq_cfg.duration = duration
-    net.update_seq_lengths(seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
 
     log.info(f'Prompt: {prompt}')
     log.info(f'Negative prompt: {negative_prompt}')
@@ -98,13 +145,21 @@ def audio(
     )
 
     audio = audios.float().cpu()[0]  # (channels, samples)
+    final_audio = postprocess_audio(audio, seq_cfg.sampling_rate, normalize, volume, peak_norm_db_for_norm)
+
+    if device == 'cuda':
+        log.info('Memory usage: %.2f GB', torch.cuda.max_memory_allocated() / (2**30))
+
+    return final_audio, seq_cfg.sampling_rate
+
 
+def postprocess_audio(audio, sampling_rate, normalize=True, volume=-23.0, peak_norm_db_for_norm=-1.0):
     # ========== 添加响度归一化处理 ==========
     if normalize:
         audio_np = audio.numpy()
         normalized_audio_np = LOUDNESS_NORM(
             audio_np,
-            sr=seq_cfg.sampling_rate,
+            sr=sampling_rate,
             target_lufs=volume,
             peak_norm_db=peak_norm_db_for_norm
         )
@@ -115,13 +170,105 @@ def audio(
         log.info('[Normalization] Skipped')
     # =========================================
 
-    final_audio = final_audio.clamp(-1, 1)  # 保证在合法范围内
-    torchaudio.save(output_path, final_audio, seq_cfg.sampling_rate)
-    log.info(f'Audio saved to {output_path}')
+    return final_audio.clamp(-1, 1)  # 保证在合法范围内
+
+
+@torch.inference_mode()
+def render_audio_batch(items: list, model_bundle: dict):
+    """
+    一次 flow-matching 采样生成多条音频。
+
+    items 中每项为 render_audio 的关键字参数（prompt, negative_prompt, duration, cfg_strength,
+    num_steps, seed, normalize, volume, peak_norm_db_for_norm），同一批必须具有相同的
+    duration / cfg_strength / num_steps。每条使用独立种子的 RNG 生成初始噪声，
+    与单条调用 render_audio 时的噪声一致。返回 [(waveform, sampling_rate), ...]。
+    """
+    setup_eval_logging()
+
+    first = items[0]
+    duration = first.get('duration', 8.0)
+    cfg_strength = first.get('cfg_strength', 4.5)
+    num_steps = first.get('num_steps', 100)
+    bs = len(items)
+
+    duration_cfg = model_bundle['duration_configs'].get(duration)
+    seq_cfg = duration_cfg.seq_cfg
+    net = duration_cfg.net
+    feature_utils = model_bundle['feature_utils']
+    device = model_bundle['device']
+    dtype = model_bundle['dtype']
+
+    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+
+    log.info(f'Batch of {bs} prompts, duration={duration}, steps={num_steps}')
+
+    # 无视频模式，与 mmaudio.eval_utils.generate 的流程一致
+    clip_features = net.get_empty_clip_sequence(bs)
+    sync_features = net.get_empty_sync_sequence(bs)
+    text_features = feature_utils.encode_text([item['prompt'] for item in items])
+    negative_text_features = feature_utils.encode_text([item.get('negative_prompt', '') for item in items])
+
+    x0 = torch.cat([
+        torch.randn(1, net.latent_seq_len, net.latent_dim, device=device, dtype=dtype,
+                    generator=torch.Generator(device=device).manual_seed(item.get('seed', 42)))
+        for item in items
+    ])
+    preprocessed_conditions = net.preprocess_conditions(clip_features, sync_features, text_features)
+    empty_conditions = net.get_empty_conditions(bs, negative_text_features=negative_text_features)
+
+    cfg_ode_wrapper = lambda t, x: net.ode_wrapper(t, x, preprocessed_conditions, empty_conditions, cfg_strength)
+    x1 = fm.to_data(cfg_ode_wrapper, x0)
+    x1 = net.unnormalize(x1)
+    spec = feature_utils.decode(x1)
+    audios = feature_utils.vocode(spec).float().cpu()
+
+    results = []
+    for i, item in enumerate(items):
+        final_audio = postprocess_audio(
+            audios[i], seq_cfg.sampling_rate,
+            normalize=item.get('normalize', True),
+            volume=item.get('volume', -23.0),
+            peak_norm_db_for_norm=item.get('peak_norm_db_for_norm', -1.0),
+        )
+        results.append((final_audio, seq_cfg.sampling_rate))
 
     if device == 'cuda':
         log.info('Memory usage: %.2f GB', torch.cuda.max_memory_allocated() / (2**30))
 
+    return results
+
+
+def audio(
+    prompt: str,
+    negative_prompt: str,
+    model_bundle: dict,
+    duration: float = 8.0,
+    cfg_strength: float = 4.5,
+    num_steps: int = 100,
+    seed: int = 42,
+    output_path: Path = Path('./output/out.wav'),
+    normalize: bool = True,
+    volume: float = -23.0,
+    peak_norm_db_for_norm: float = -1.0,
+):
+    output_path = Path(output_path).expanduser()
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    final_audio, sampling_rate = render_audio(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        model_bundle=model_bundle,
+        duration=duration,
+        cfg_strength=cfg_strength,
+        num_steps=num_steps,
+        seed=seed,
+        normalize=normalize,
+        volume=volume,
+        peak_norm_db_for_norm=peak_norm_db_for_norm,
+    )
+    torchaudio.save(output_path, final_audio, sampling_rate)
+    log.info(f'Audio saved to {output_path}')
+
     return output_path
 
 
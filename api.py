@@ -2,8 +2,171 @@ import requests
 import os
 import time
 import json
+import random
+import asyncio
+import functools
+import weakref
+import struct
+import zipfile
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from balancer import EndpointPool
 
-def audio(prompt: str, duration: float, volume: float, negative_prompt: str, output_path: str):
+# --- 服务节点 ---
+# 每种能力一个节点池，逗号分隔的地址列表；未单独配置时使用 AUDIOBOOK_ENDPOINTS，再退回本机
+DEFAULT_ENDPOINT = "http://localhost:8000"
+
+def _endpoints_from_env(capability: str):
+    value = os.environ.get(f"AUDIOBOOK_{capability}_ENDPOINTS") or os.environ.get("AUDIOBOOK_ENDPOINTS") or DEFAULT_ENDPOINT
+    return [url.strip() for url in value.split(',') if url.strip()]
+
+TTS_POOL = EndpointPool(_endpoints_from_env("TTS"), model="cosyvoice")
+AUDIO_POOL = EndpointPool(_endpoints_from_env("AUDIO"), model="mmaudio")
+RAG_POOL = EndpointPool(_endpoints_from_env("RAG"), model="rag")
+
+def configure_endpoints(tts: list = None, audio: list = None, rag: list = None):
+    """替换各能力的服务节点列表（如来自命令行参数），未提供的保持不变。"""
+    for pool, urls in ((TTS_POOL, tts), (AUDIO_POOL, audio), (RAG_POOL, rag)):
+        if urls:
+            pool.set_endpoints(urls)
+
+def _voice_key(prompt_text: str, prompt_speech_path: str = None, speaker_id: str = None):
+    """说话人亲和键：同一音色的注册与合成请求落到同一节点，保持其提示特征缓存常驻。"""
+    if prompt_speech_path:
+        return f"{os.path.abspath(prompt_speech_path)}|{prompt_text}"
+    return speaker_id
+
+# --- HTTP 客户端 ---
+REQUEST_TIMEOUT = 300   # 秒，单次请求的超时
+MAX_RETRIES = 3         # 5xx / 429 / 超时 / 连接错误时的最多重试次数
+BACKOFF_BASE = 0.5      # 指数退避的基数（秒），第 n 次重试最多等待 BACKOFF_BASE * 2**n
+BACKOFF_MAX = 10.0
+POOL_MAXSIZE = 32       # 每个节点保持的 keep-alive 连接数上限，应不小于并发线程数
+
+class ApiError(Exception):
+    """服务调用失败。status_code 为 HTTP 状态码，网络错误时为 None。"""
+
+    def __init__(self, message, status_code=None, url=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.url = url
+
+class ApiClientError(ApiError):
+    """4xx（429 除外）：请求本身有误，不重试。"""
+
+class ApiServerError(ApiError):
+    """5xx 或 429：重试用尽后仍失败。"""
+
+class ApiConnectionError(ApiError):
+    """无法连接到服务节点。"""
+
+class ApiTimeoutError(ApiError):
+    """请求超时，或超过了调用方给定的截止时间。"""
+
+class ApiClient:
+    """
+    所有 api 函数共用的 HTTP 客户端。
+
+    - 一个 requests.Session，按节点复用 keep-alive 连接，避免每个片段重新建立 TCP 连接；
+    - 5xx、429、超时和连接错误按指数退避（带随机抖动）重试，每次重试重新从节点池选择节点，
+      出错的节点已被摘除，重试会落到其他节点上；429 至少等待 Retry-After；
+    - deadline（秒）限制包括重试在内的总耗时；
+    - 失败时抛出 ApiError 的子类，而不是返回 None。
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, timeout=REQUEST_TIMEOUT, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, pool_maxsize=POOL_MAXSIZE):
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        try:
+            return max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            return delay
+
+    @staticmethod
+    def _status_error(response, url):
+        message = f"{url} 返回 {response.status_code}: {response.text[:500]}"
+        if response.status_code == 429 or response.status_code >= 500:
+            return ApiServerError(message, response.status_code, url)
+        return ApiClientError(message, response.status_code, url)
+
+    def post(self, pool, path, affinity_key=None, endpoint=None, deadline=None, timeout=None, **kwargs):
+        """
+        向 pool 中的节点 POST path，返回 2xx 响应；stream=True 时调用方负责关闭响应。
+
+        Args:
+            affinity_key: 传给 pool.route() 的亲和键。
+            endpoint: 指定节点（如批量请求已按节点分组），重试也发往该节点。
+            deadline (float): 包括重试在内的总时限（秒），None 表示不限。
+            timeout (float): 单次请求超时，默认 self.timeout。
+            kwargs: 传给 Session.post 的其余参数；files 需为可重复发送的字节内容。
+        """
+        timeout = timeout or self.timeout
+        deadline_at = None if deadline is None else time.monotonic() + deadline
+        for attempt in range(self.max_retries + 1):
+            attempt_timeout = timeout
+            if deadline_at is not None:
+                remaining = deadline_at - time.monotonic()
+                if remaining <= 0:
+                    raise ApiTimeoutError(f"POST {path} 超过截止时间 {deadline}s")
+                attempt_timeout = min(timeout, remaining)
+
+            target = endpoint or pool.route(affinity_key)
+            url = target.url + path
+            retry_after = None
+            try:
+                # track() 在网络异常时摘除节点
+                with pool.track(target):
+                    response = self.session.post(url, timeout=attempt_timeout, **kwargs)
+            except requests.exceptions.Timeout as e:
+                error = ApiTimeoutError(f"{url} 请求超时: {e}", url=url)
+            except requests.exceptions.RequestException as e:
+                error = ApiConnectionError(f"{url} 连接失败: {e}", url=url)
+            else:
+                retry_after = response.headers.get("Retry-After")
+                pool.report(target, response.status_code, retry_after)
+                if response.ok:
+                    return response
+                error = self._status_error(response, url)
+                response.close()
+                if isinstance(error, ApiClientError):
+                    raise error
+
+            if attempt == self.max_retries:
+                raise error
+            delay = self._backoff(attempt, retry_after)
+            if deadline_at is not None and time.monotonic() + delay >= deadline_at:
+                raise ApiTimeoutError(f"POST {path} 在截止时间 {deadline}s 内未成功: {error}",
+                                      error.status_code, error.url) from error
+            print(f"⚠️ {error}，{delay:.1f} 秒后重试 ({attempt + 1}/{self.max_retries})")
+            time.sleep(delay)
+
+CLIENT = ApiClient()
+
+def _upload_file(path: str, content_type: str = 'audio/wav'):
+    """读入待上传的文件：文件句柄立即关闭，字节内容可在重试时重复发送。"""
+    with open(path, 'rb') as f:
+        return (os.path.basename(path), f.read(), content_type)
+
+def _write_output(output_path: str, content: bytes):
+    output_dir = os.path.dirname(output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(output_path, 'wb') as f:
+        f.write(content)
+
+def audio(prompt: str, duration: float, volume: float, negative_prompt: str, output_path: str, quality: str = None,
+          deadline: float = None):
     """
     调用音频生成 API 的客户端函数。
 
@@ -13,10 +176,12 @@ def audio(prompt: str, duration: float, volume: float, negative_prompt: str, out
         volume (float): 目标音量 (LUFS)。
         negative_prompt (str): 负向提示词。
         output_path (str): 保存音频文件的完整路径。
-    """
-    # API 服务器的地址
-    api_url = "http://localhost:8000/audio"
+        quality (str): 质量档位（"draft" / "final"），None 时使用服务端默认档位。
+        deadline (float): 包括重试在内的总时限（秒）。
 
+    Raises:
+        ApiError: 重试后仍失败。
+    """
     # 准备要发送的 JSON 数据
     payload = {
         "prompt": prompt,
@@ -25,65 +190,57 @@ def audio(prompt: str, duration: float, volume: float, negative_prompt: str, out
         "negative_prompt": negative_prompt,
         # 其他参数（如 seed, cfg_strength 等）将使用 API 端的默认值
     }
+    if quality:
+        payload["quality"] = quality
 
-    # print(f"正在向 API 发送请求: {api_url}")
     # print(f"请求参数: {payload}")
 
-    try:
-        start_time = time.time()
-        # 发送 POST 请求
-        response = requests.post(api_url, json=payload, timeout=300) # 设置一个较长的超时时间
-        end_time = time.time()
-
-        # 检查响应状态码
-        if response.status_code == 200:
-            # 确保输出目录存在
-            output_dir = os.path.dirname(output_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-
-            # 将收到的音频数据写入文件
-            with open(output_path, 'wb') as f:
-                f.write(response.content)
-            
-            # print(f"\n请求成功！音频已保存至: {output_path}")
-            # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
-            return output_path
-        else:
-            # 如果服务器返回错误，则打印错误信息
-            print(f"\n请求失败，状态码: {response.status_code}")
-            print(f"错误详情: {response.text}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        print(f"\n调用 API 时发生网络错误: {e}")
-        print("请确保 API 服务 (app.py) 正在运行，并且地址正确。")
-        return None
+    start_time = time.time()
+    # 发送 POST 请求到在途请求最少的 MMAudio 节点
+    response = CLIENT.post(AUDIO_POOL, "/audio", json=payload, deadline=deadline)
+    end_time = time.time()
 
-def tts(tts_text: str, prompt_text: str, prompt_speech_path: str, output_path: str, speaker: str,
-        speed: float = 1.0, normalize: bool = True, volume: float = -23.0, peak_norm_db_for_norm: float = -1.0):
+    # 将收到的音频数据写入文件
+    _write_output(output_path, response.content)
+    # print(f"\n请求成功！音频已保存至: {output_path}")
+    # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
+    return output_path
+
+# (提示音频路径, mtime, 提示文本) -> speaker_id，同一进程内每个音色只注册一次
+_speaker_ids = {}
+
+def register_speaker(prompt_text: str, prompt_speech_path: str, deadline: float = None):
     """
-    调用 TTS 音频生成 API 的客户端函数。
+    在服务端注册一个音色，返回 speaker_id；之后 tts() 传入 speaker_id 即可，无需再上传提示音频。
 
     Args:
-        tts_text (str): 要转换为语音的文本。
         prompt_text (str): 提示文本。
         prompt_speech_path (str): 用作声音提示的音频文件路径。
-        output_path (str): 保存生成音频的完整路径。
-        speaker (str): 说话人。
-        speed (float): 语速。
-        normalize (bool): 是否进行归一化。
-        volume (float): 目标音量 (LUFS)。
-        peak_norm_db_for_norm (float): 归一化峰值归一化 dB。
-    """
-    api_url = "http://localhost:8000/tts"
+        deadline (float): 包括重试在内的总时限（秒）。
 
-    # 检查提示音频文件是否存在
+    Raises:
+        FileNotFoundError: 提示音频不存在。
+        ApiError: 重试后仍失败。
+    """
     if not os.path.exists(prompt_speech_path):
-        print(f"错误：提示音频文件未找到: {prompt_speech_path}")
-        return None
+        raise FileNotFoundError(f"提示音频文件未找到: {prompt_speech_path}")
+
+    memo_key = (os.path.abspath(prompt_speech_path), os.path.getmtime(prompt_speech_path), prompt_text)
+    if memo_key in _speaker_ids:
+        return _speaker_ids[memo_key]
+
+    response = CLIENT.post(TTS_POOL, "/speakers", affinity_key=_voice_key(prompt_text, prompt_speech_path),
+                           data={"prompt_text": prompt_text},
+                           files={"prompt_speech_file": _upload_file(prompt_speech_path)}, deadline=deadline)
+    speaker_id = response.json()["speaker_id"]
+    _speaker_ids[memo_key] = speaker_id
+    return speaker_id
+
+def _tts_form(tts_text, prompt_text, prompt_speech_path, speed, normalize, volume, peak_norm_db_for_norm, speaker_id):
+    """tts() / tts_stream() 共用的表单数据与上传文件。"""
+    if not speaker_id and not os.path.exists(prompt_speech_path):
+        raise FileNotFoundError(f"提示音频文件未找到: {prompt_speech_path}")
 
-    # 准备表单数据和文件
     data = {
         "tts_text": tts_text,
         "prompt_text": prompt_text,
@@ -92,39 +249,183 @@ def tts(tts_text: str, prompt_text: str, prompt_speech_path: str, output_path: s
         "volume": volume,
         "peak_norm_db_for_norm": peak_norm_db_for_norm,
     }
-    files = {
-        "prompt_speech_file": (os.path.basename(prompt_speech_path), open(prompt_speech_path, 'rb'), 'audio/wav')
-    }
+    if speaker_id:
+        data["speaker_id"] = speaker_id
+        files = None
+    else:
+        files = {"prompt_speech_file": _upload_file(prompt_speech_path)}
+    return data, files
+
+def tts(tts_text: str, prompt_text: str, prompt_speech_path: str, output_path: str, speaker: str,
+        speed: float = 1.0, normalize: bool = True, volume: float = -23.0, peak_norm_db_for_norm: float = -1.0,
+        speaker_id: str = None, deadline: float = None):
+    """
+    调用 TTS 音频生成 API 的客户端函数。
+
+    Args:
+        tts_text (str): 要转换为语音的文本。
+        prompt_text (str): 提示文本。
+        prompt_speech_path (str): 用作声音提示的音频文件路径。
+        output_path (str): 保存生成音频的完整路径。
+        speaker (str): 说话人。
+        speed (float): 语速。
+        normalize (bool): 是否进行归一化。
+        volume (float): 目标音量 (LUFS)。
+        peak_norm_db_for_norm (float): 归一化峰值归一化 dB。
+        speaker_id (str): register_speaker() 返回的 ID；提供时不再上传提示音频。
+        deadline (float): 包括重试在内的总时限（秒）。
+
+    Raises:
+        FileNotFoundError: 未提供 speaker_id 且提示音频不存在。
+        ApiError: 重试后仍失败。
+    """
+    data, files = _tts_form(tts_text, prompt_text, prompt_speech_path, speed, normalize, volume,
+                            peak_norm_db_for_norm, speaker_id)
 
     print(f"💂‍♂️ {speaker}: {tts_text}")
-    
+
+    start_time = time.time()
     try:
-        start_time = time.time()
-        response = requests.post(api_url, data=data, files=files, timeout=300)
-        end_time = time.time()
-
-        if response.status_code == 200:
-            output_dir = os.path.dirname(output_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            
+        # 按说话人一致性哈希选择节点
+        response = CLIENT.post(TTS_POOL, "/tts", affinity_key=_voice_key(prompt_text, prompt_speech_path, speaker_id),
+                               data=data, files=files, deadline=deadline)
+    except ApiClientError as e:
+        if e.status_code == 404 and speaker_id and os.path.exists(prompt_speech_path):
+            # 节点变动后新节点尚未注册该音色：改为上传提示音频，服务端会顺带注册
+            return tts(tts_text, prompt_text, prompt_speech_path, output_path, speaker, speed=speed, normalize=normalize,
+                       volume=volume, peak_norm_db_for_norm=peak_norm_db_for_norm, deadline=deadline)
+        raise
+    end_time = time.time()
+
+    _write_output(output_path, response.content)
+    # print(f"\nTTS 请求成功！音频已保存至: {output_path}")
+    # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
+    return output_path
+
+# 流式 WAV 头中长度未知时的占位值
+STREAM_WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+def _patch_wav_sizes(wav_path: str):
+    """流式接收结束后，按实际文件大小补写 44 字节 WAV 头中的 RIFF/data 长度。"""
+    size = os.path.getsize(wav_path)
+    with open(wav_path, 'r+b') as f:
+        header = f.read(44)
+        if len(header) < 44 or struct.unpack('<I', header[40:44])[0] != STREAM_WAV_UNKNOWN_SIZE:
+            return
+        f.seek(4)
+        f.write(struct.pack('<I', size - 8))
+        f.seek(40)
+        f.write(struct.pack('<I', size - 44))
+
+def tts_stream(tts_text: str, prompt_text: str, prompt_speech_path: str, output_path: str, speaker: str,
+               speed: float = 1.0, normalize: bool = True, volume: float = -23.0, peak_norm_db_for_norm: float = -1.0,
+               speaker_id: str = None, on_chunk=None, deadline: float = None):
+    """
+    流式 TTS 客户端：参数与 tts() 相同，音频边生成边写入 output_path，结束后补全 WAV 头。
+    只有建立连接前的失败会重试；开始接收音频后中断则删除不完整的文件并抛出 ApiError。
+
+    Args:
+        on_chunk (callable): 可选，每收到一段数据即以原始字节调用（首段含 WAV 头），可用于实时试听。
+    """
+    data, files = _tts_form(tts_text, prompt_text, prompt_speech_path, speed, normalize, volume,
+                            peak_norm_db_for_norm, speaker_id)
+
+    print(f"💂‍♂️ {speaker}: {tts_text}")
+
+    with CLIENT.post(TTS_POOL, "/tts_stream", affinity_key=_voice_key(prompt_text, prompt_speech_path, speaker_id),
+                     data=data, files=files, stream=True, deadline=deadline) as response:
+        output_dir = os.path.dirname(output_path)
+        if output_dir and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        try:
             with open(output_path, 'wb') as f:
-                f.write(response.content)
-            
-            # print(f"\nTTS 请求成功！音频已保存至: {output_path}")
-            # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
-            return output_path
-        else:
-            print(f"\nTTS 请求失败，状态码: {response.status_code}")
-            print(f"错误详情: {response.text}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        print(f"\n调用 TTS API 时发生网络错误: {e}")
-        print("请确保 API 服务 (app.py) 正在运行，并且地址正确。")
-        return None
-
-def rag(query_file_path: str, doc_file_path: str, output_path: str):
+                for chunk in response.iter_content(chunk_size=None):
+                    f.write(chunk)
+                    if on_chunk is not None:
+                        on_chunk(chunk)
+        except requests.exceptions.RequestException as e:
+            # 服务端中途出错会中断分块传输，已写入的部分不可用
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise ApiConnectionError(f"{response.url} 流式传输中断: {e}", url=response.url) from e
+    _patch_wav_sizes(output_path)
+    return output_path
+
+def tts_batch(lines: list, deadline: float = None):
+    """
+    调用批量 TTS 接口：一次请求合成多行，每个不同的提示音频只上传一次。
+    多个 TTS 节点时按说话人亲和把各行分到对应节点，每个节点一个子批次并发发送。
+
+    Args:
+        lines (list): 每项为 dict，字段与 tts() 的参数一致：
+            tts_text, prompt_text, prompt_speech_path, output_path, speaker，
+            以及可选的 speed, normalize, volume, peak_norm_db_for_norm。
+        deadline (float): 每个子批次包括重试在内的总时限（秒）。
+
+    Returns:
+        list: 与 lines 一一对应的输出路径，服务端报告生成失败的行为 None。
+
+    Raises:
+        FileNotFoundError: 某行的提示音频不存在。
+        ApiError: 某个子批次的请求重试后仍失败。
+    """
+    for line in lines:
+        if not os.path.exists(line["prompt_speech_path"]):
+            raise FileNotFoundError(f"提示音频文件未找到: {line['prompt_speech_path']}")
+
+    groups = {}
+    for index, line in enumerate(lines):
+        endpoint = TTS_POOL.route(_voice_key(line["prompt_text"], line["prompt_speech_path"]))
+        groups.setdefault(endpoint.url, (endpoint, []))[1].append(index)
+
+    output_paths = [None] * len(lines)
+    with ThreadPoolExecutor(max_workers=len(groups) or 1) as pool:
+        futures = {
+            pool.submit(_tts_batch_on, endpoint, [lines[i] for i in indices], deadline): indices
+            for endpoint, indices in groups.values()
+        }
+        for future, indices in futures.items():
+            for index, output_path in zip(indices, future.result()):
+                output_paths[index] = output_path
+    return output_paths
+
+def _tts_batch_on(endpoint, lines: list, deadline: float = None):
+    """向指定节点发送一个批量 TTS 请求。"""
+    # 相同的提示音频只上传一次，按 prompt_ref 引用
+    prompt_refs = {}
+    payload = []
+    for line in lines:
+        prompt_speech_path = line["prompt_speech_path"]
+        ref = prompt_refs.setdefault(prompt_speech_path, f"prompt_{len(prompt_refs)}")
+        payload.append({
+            "tts_text": line["tts_text"],
+            "prompt_text": line["prompt_text"],
+            "prompt_ref": ref,
+            "speed": line.get("speed", 1.0),
+            "normalize": line.get("normalize", True),
+            "volume": line.get("volume", -23.0),
+            "peak_norm_db_for_norm": line.get("peak_norm_db_for_norm", -1.0),
+        })
+        print(f"💂‍♂️ {line.get('speaker', '')}: {line['tts_text']}")
+
+    files = {ref: _upload_file(path) for path, ref in prompt_refs.items()}
+    response = CLIENT.post(TTS_POOL, "/tts_batch", endpoint=endpoint,
+                           data={"lines": json.dumps(payload, ensure_ascii=False)}, files=files,
+                           timeout=REQUEST_TIMEOUT + 60 * len(lines), deadline=deadline)
+
+    output_paths = [None] * len(lines)
+    with zipfile.ZipFile(BytesIO(response.content)) as zf:
+        for result in json.loads(zf.read("results.json")):
+            index = result["index"]
+            if "error" in result:
+                print(f"\nTTS 第 {index} 行生成失败: {result['error']}")
+                continue
+            _write_output(lines[index]["output_path"], zf.read(result["file"]))
+            output_paths[index] = lines[index]["output_path"]
+    return output_paths
+
+def rag(query_file_path: str, doc_file_path: str, output_path: str, deadline: float = None):
     """
     调用 RAG 说话人匹配 API 的客户端函数。
 
@@ -132,50 +433,107 @@ def rag(query_file_path: str, doc_file_path: str, output_path: str):
         query_file_path (str): 包含查询说话人信息的 JSONL 文件路径。
         doc_file_path (str): 包含声音特征文档的 JSON 文件路径。
         output_path (str): 保存匹配结果的 JSON 文件路径。
-    """
-    api_url = "http://localhost:8000/rag_speakers"
-
-    # 检查输入文件是否存在
-    if not os.path.exists(query_file_path):
-        print(f"错误：查询文件未找到: {query_file_path}")
-        return None
-    if not os.path.exists(doc_file_path):
-        print(f"错误：文档文件未找到: {doc_file_path}")
-        return None
+        deadline (float): 包括重试在内的总时限（秒）。
 
+    Raises:
+        FileNotFoundError: 输入文件不存在。
+        ApiError: 重试后仍失败。
+    """
     # 准备文件
     files = {
-        "query_file": (os.path.basename(query_file_path), open(query_file_path, 'rb'), 'application/jsonl'),
-        "doc_file": (os.path.basename(doc_file_path), open(doc_file_path, 'rb'), 'application/json')
+        "query_file": _upload_file(query_file_path, 'application/jsonl'),
+        "doc_file": _upload_file(doc_file_path, 'application/json'),
     }
 
-    # print(f"正在向 API 发送 RAG 请求: {api_url}")
-    
-    try:
-        start_time = time.time()
-        response = requests.post(api_url, files=files, timeout=300)
-        end_time = time.time()
-
-        if response.status_code == 200:
-            output_dir = os.path.dirname(output_path)
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
-            
-            with open(output_path, 'wb') as f:
-                f.write(response.content)
-            
-            print(f"🎉 角色匹配成功!")
-            # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
-            return output_path
-        else:
-            print(f"\nRAG 请求失败，状态码: {response.status_code}")
-            print(f"错误详情: {response.text}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        print(f"\n调用 RAG API 时发生网络错误: {e}")
-        print("请确保 API 服务 (app.py) 正在运行，并且地址正确。")
-        return None
+    start_time = time.time()
+    response = CLIENT.post(RAG_POOL, "/rag_speakers", files=files, deadline=deadline)
+    end_time = time.time()
+
+    _write_output(output_path, response.content)
+    print(f"🎉 角色匹配成功!")
+    # print(f"API 调用及文件下载耗时 {end_time - start_time:.2f} 秒。")
+    return output_path
+
+
+# --- asyncio 接口 ---
+# 协程版本在独立线程池中调用上面的同步函数，共用 CLIENT 的连接池；
+# 同一事件循环内的在途请求数由信号量限制，超出的协程排队等待
+ASYNC_CONCURRENCY = 16
+_async_executor = ThreadPoolExecutor(max_workers=POOL_MAXSIZE, thread_name_prefix='api-async')
+_async_limits = weakref.WeakKeyDictionary()  # 事件循环 -> asyncio.Semaphore
+
+def set_async_concurrency(limit: int):
+    """设置每个事件循环的在途请求上限，对之后新建的事件循环生效（不应超过 POOL_MAXSIZE）。"""
+    global ASYNC_CONCURRENCY
+    ASYNC_CONCURRENCY = limit
+    _async_limits.clear()
+
+def _async_limit():
+    loop = asyncio.get_running_loop()
+    limit = _async_limits.get(loop)
+    if limit is None:
+        limit = _async_limits[loop] = asyncio.Semaphore(ASYNC_CONCURRENCY)
+    return limit
+
+async def _run_async(fn, *args, **kwargs):
+    async with _async_limit():
+        return await asyncio.get_running_loop().run_in_executor(_async_executor, functools.partial(fn, *args, **kwargs))
+
+async def audio_async(*args, **kwargs):
+    """audio() 的协程版本，参数与返回值相同。"""
+    return await _run_async(audio, *args, **kwargs)
+
+async def tts_async(*args, **kwargs):
+    """tts() 的协程版本，参数与返回值相同。"""
+    return await _run_async(tts, *args, **kwargs)
+
+async def rag_async(*args, **kwargs):
+    """rag() 的协程版本，参数与返回值相同。"""
+    return await _run_async(rag, *args, **kwargs)
+
+CLIP_RENDERERS = {"audio": audio_async, "tts": tts_async, "rag": rag_async}
+
+def print_clip_progress(done: int, total: int, spec: dict, outcome):
+    """render_clips() 的默认进度回调。"""
+    target = os.path.basename(spec.get("output_path", ""))
+    if isinstance(outcome, BaseException):
+        print(f"🛑 [{done}/{total}] {target} 生成失败: {outcome}")
+    else:
+        print(f"✅ [{done}/{total}] {target}")
+
+async def render_clips(specs: list, on_progress=print_clip_progress, return_exceptions: bool = False):
+    """
+    并发渲染一组片段，类似 asyncio.gather。
+
+    Args:
+        specs (list): 每项为 dict，"kind" 为 "audio" / "tts" / "rag"，其余字段作为对应函数的关键字参数。
+        on_progress (callable): 每完成一个片段调用 on_progress(done, total, spec, 结果或异常)；None 表示不报告。
+        return_exceptions (bool): True 时失败片段的异常放在结果列表中；False 时等全部片段结束后抛出第一个异常。
+
+    Returns:
+        list: 与 specs 一一对应的结果（输出路径）。
+    """
+    total = len(specs)
+    done = 0
+
+    async def render(spec):
+        nonlocal done
+        kwargs = {key: value for key, value in spec.items() if key != "kind"}
+        try:
+            result = await CLIP_RENDERERS[spec["kind"]](**kwargs)
+        except Exception as e:
+            result = e
+        done += 1
+        if on_progress is not None:
+            on_progress(done, total, spec, result)
+        return result
+
+    results = await asyncio.gather(*(render(spec) for spec in specs))
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
 
 
 if __name__ == '__main__':
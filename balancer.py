@@ -0,0 +1,157 @@
+import bisect
+import hashlib
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+HEALTH_CHECK_INTERVAL = 10.0  # 秒，多于一个节点时后台轮询 /health
+HEALTH_CHECK_TIMEOUT = 2.0
+EJECT_SECONDS = 30.0          # 请求失败后节点被摘除的时长，到期后重新参与调度
+VIRTUAL_NODES = 64            # 一致性哈希环上每个节点的虚拟节点数
+AFFINITY_LOAD_FACTOR = 1.25   # 亲和节点的在途请求超过平均值的该倍数时顺延到环上下一个节点
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.requests = 0
+        self.healthy = True
+        self.ejected_until = 0.0
+
+    def available(self, now):
+        return self.healthy and now >= self.ejected_until
+
+    def __repr__(self):
+        return f"Endpoint({self.url}, outstanding={self.outstanding}, healthy={self.healthy})"
+
+
+class EndpointPool:
+    """
+    同一能力（TTS / MMAudio / RAG）的一组服务节点。
+
+    - 默认选择在途请求最少的可用节点；
+    - 传入 affinity_key 时按一致性哈希选择节点（如按说话人），使同一音色的提示特征缓存留在同一节点；
+      该节点明显过载时顺延到环上的下一个节点；
+    - 请求出错、5xx 或 429 时暂时摘除节点；多节点时后台线程按 model 字段检查 /health 的模型就绪状态。
+    所有节点都不可用时退回到全部节点，保证请求总能发出。
+    """
+
+    def __init__(self, urls, model=None, health_interval=HEALTH_CHECK_INTERVAL, eject_seconds=EJECT_SECONDS):
+        self.model = model
+        self.health_interval = health_interval
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._ring_cache = (None, [], [])
+        self._health_thread = None
+        self.set_endpoints(urls)
+
+    def set_endpoints(self, urls):
+        if not urls:
+            raise ValueError("EndpointPool needs at least one endpoint")
+        with self._lock:
+            existing = {endpoint.url: endpoint for endpoint in getattr(self, 'endpoints', [])}
+            self.endpoints = [existing.get(url.rstrip('/')) or Endpoint(url) for url in urls]
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def _ring(self, candidates):
+        key = tuple(endpoint.url for endpoint in candidates)
+        if self._ring_cache[0] != key:
+            points = sorted(
+                ((_hash(f"{endpoint.url}#{i}"), endpoint) for endpoint in candidates for i in range(VIRTUAL_NODES)),
+                key=lambda point: point[0],
+            )
+            self._ring_cache = (key, [h for h, _ in points], [endpoint for _, endpoint in points])
+        return self._ring_cache[1], self._ring_cache[2]
+
+    def route(self, affinity_key=None):
+        """选择一个节点（不计入在途请求）。"""
+        self._ensure_health_thread()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.available(now)] or list(self.endpoints)
+            if affinity_key is None or len(candidates) == 1:
+                return min(candidates, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+
+            hashes, ring = self._ring(candidates)
+            total = sum(endpoint.outstanding for endpoint in candidates)
+            limit = math.ceil((total + 1) / len(candidates) * AFFINITY_LOAD_FACTOR)
+            start = bisect.bisect(hashes, _hash(str(affinity_key))) % len(ring)
+            for i in range(len(ring)):
+                endpoint = ring[(start + i) % len(ring)]
+                if endpoint.outstanding < limit:
+                    return endpoint
+            return ring[start]
+
+    @contextmanager
+    def track(self, endpoint):
+        """在途请求计数；块内抛出的网络异常会摘除该节点。"""
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        try:
+            yield endpoint
+        except requests.exceptions.RequestException:
+            self.eject(endpoint)
+            raise
+        finally:
+            with self._lock:
+                endpoint.outstanding -= 1
+
+    @contextmanager
+    def acquire(self, affinity_key=None):
+        with self.track(self.route(affinity_key)) as endpoint:
+            yield endpoint
+
+    def eject(self, endpoint, seconds=None):
+        with self._lock:
+            endpoint.ejected_until = time.monotonic() + (self.eject_seconds if seconds is None else seconds)
+
+    def report(self, endpoint, status_code, retry_after=None):
+        """根据响应状态码调整节点状态：5xx 摘除，429 按 Retry-After 暂停。"""
+        if status_code == 429:
+            try:
+                seconds = float(retry_after)
+            except (TypeError, ValueError):
+                seconds = 1.0
+            self.eject(endpoint, seconds)
+        elif status_code >= 500:
+            self.eject(endpoint)
+
+    # --- 健康检查 ---
+    def _ensure_health_thread(self):
+        if len(self.endpoints) < 2 or self._health_thread is not None:
+            return
+        with self._lock:
+            if self._health_thread is None:
+                self._health_thread = threading.Thread(target=self._health_loop, name='endpoint-health', daemon=True)
+                self._health_thread.start()
+
+    def check_health(self):
+        for endpoint in list(self.endpoints):
+            try:
+                response = requests.get(endpoint.url + "/health", timeout=HEALTH_CHECK_TIMEOUT)
+                body = response.json()
+                if self.model is not None and self.model in body.get("models_loaded", {}):
+                    healthy = bool(body["models_loaded"][self.model])
+                else:
+                    healthy = response.status_code == 200
+            except (requests.exceptions.RequestException, ValueError):
+                healthy = False
+            with self._lock:
+                endpoint.healthy = healthy
+
+    def _health_loop(self):
+        while True:
+            self.check_health()
+            time.sleep(self.health_interval)
@@ -52,40 +52,73 @@ def collect_and_check_audio_data(data):
     return fg_audios, bg_audios
 
 
+def new_wav_counters():
+    return {
+        'bg_sound_effect': 0,
+        'bg_music': 0,
+        'idle': 0,
+        'fg_sound_effect': 0,
+        'fg_music': 0,
+        'fg_speech': 0,
+    }
+
+def make_wav_name(audio, wav_counters):
+    audio_type = normalize_audio_type(audio['audio_type'])
+    layout = 'fg' if audio['layout'] == 'foreground' else 'bg'
+    wav_type = f'{layout}_{audio_type}'
+    desc = audio.get('text', audio.get('desc', ''))
+    desc = utils.text_to_abbrev_prompt(desc)
+    wav_filename = f'{wav_type}_{wav_counters[wav_type]}_{desc}.wav'
+    wav_counters[wav_type] += 1
+    return wav_filename
+
+def resolve_voice(char_to_voice_map, character):
+    """返回 (prompt_text, 参考音频路径)，与生成代码中 tts() 的参数一致。"""
+    voice = char_to_voice_map[character]
+    ref_path = ""
+    if "npz_path" in voice:
+        ref_path = voice["npz_path"]
+    if "wav_path" in voice:
+        ref_path = voice["wav_path"]
+    ref_full_path = os.path.abspath(ref_path) if os.path.exists(ref_path) else ref_path
+    return voice["asr_text"], ref_full_path
+
+def load_audio_script(script_filename):
+    data = []
+    with open(script_filename, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                json_object = json5.loads(line)
+                data.append(json_object)
+    return data
+
+
 class AudioCodeGenerator:
     def __init__(self):
-        self.wav_counters = {
-            'bg_sound_effect': 0,
-            'bg_music': 0,
-            'idle': 0,
-            'fg_sound_effect': 0,
-            'fg_music': 0,
-            'fg_speech': 0,
-        }
+        self.wav_counters = new_wav_counters()
         self.code = ''
     
     def append_code(self, content):
         self.code += content + '\n'
 
-    def generate_code(self, fg_audios, bg_audios, output_path, result_filename):
+    def generate_code(self, fg_audios, bg_audios, output_path, result_filename, quality=None):
         def get_wav_name(audio):
-            audio_type = normalize_audio_type(audio['audio_type'])
-            layout = 'fg' if audio['layout'] == 'foreground' else 'bg'
-            wav_type = f'{layout}_{audio_type}'
-            desc = audio.get('text', audio.get('desc', ''))
-            desc = utils.text_to_abbrev_prompt(desc)
-            wav_filename = f'{wav_type}_{self.wav_counters[wav_type]}_{desc}.wav'
-            self.wav_counters[wav_type] += 1
-            return wav_filename
+            return make_wav_name(audio, self.wav_counters)
+
+        # MMAudio 质量档位（draft/final），未指定时使用服务端默认
+        quality_arg = f', quality="{quality}"' if quality else ''
 
         header = f'''
 import os
 import time
 import sys
 import datetime
-import torch
-from utils import MIX, CAT, COMPUTE_LEN, LOOP
-from api import tts, audio
+import asyncio
+from utils import MIX, CAT
+from mixer import LoopSource
+from timeline import Timeline
+from api import render_clips
 wav_path = \"{output_path.absolute()}/audio\"
 os.makedirs(wav_path, exist_ok=True)
 
@@ -102,17 +135,12 @@ os.makedirs(wav_path, exist_ok=True)
             audio_type = normalize_audio_type(fg_audio['audio_type'])
 
             if audio_type in ['sound_effect', 'music']:
-                line1 = f'audio(prompt="{fg_audio["desc"]}", duration={fg_audio["len"]}, volume={fg_audio["vol"]}, negative_prompt=" ", output_path=os.path.join(wav_path, "{wav_name}"))'
+                line1 = f'dict(kind="audio", prompt="{fg_audio["desc"]}", duration={fg_audio["len"]}, volume={fg_audio["vol"]}, negative_prompt=" "{quality_arg}, output_path=os.path.join(wav_path, "{wav_name}"))'
                 code_block_one.extend([line1])
 
             elif audio_type == 'speech':
-                ref_path = ""
-                if "npz_path" in self.char_to_voice_map[fg_audio["character"]]:
-                    ref_path = self.char_to_voice_map[fg_audio["character"]]["npz_path"]
-                if "wav_path" in self.char_to_voice_map[fg_audio["character"]]:
-                    ref_path = self.char_to_voice_map[fg_audio["character"]]["wav_path"]
-                ref_full_path = os.path.abspath(ref_path) if os.path.exists(ref_path) else ref_path
-                line1 = f'tts(tts_text="{fg_audio["text"]}", prompt_text="{self.char_to_voice_map[fg_audio["character"]]["asr_text"]}", prompt_speech_path="{ref_full_path}", speaker="{fg_audio["character"]}", volume={fg_audio["vol"]}, output_path=os.path.join(wav_path, "{wav_name}"))'
+                prompt_text, ref_full_path = resolve_voice(self.char_to_voice_map, fg_audio["character"])
+                line1 = f'dict(kind="tts", tts_text="{fg_audio["text"]}", prompt_text="{prompt_text}", prompt_speech_path="{ref_full_path}", speaker="{fg_audio["character"]}", volume={fg_audio["vol"]}, output_path=os.path.join(wav_path, "{wav_name}"))'
                 
                 code_block_two.extend([line1])
             fg_audio_wavs.append(wav_name)
@@ -123,14 +151,10 @@ os.makedirs(wav_path, exist_ok=True)
             audio_type = normalize_audio_type(bg_audio['audio_type'])
 
             # Generate a fixed-length clip for all background audios.
-            # The LOOP function will later stretch or trim it to the correct length.
+            # LoopSource will later loop or trim it to the correct length.
             A_len = 30  # Fixed duration for the seed audio
-            if audio_type == 'sound_effect':
-                code_block_one.append(f'audio(prompt=\"{bg_audio["desc"]}\", volume={bg_audio["vol"]}, duration={A_len}, negative_prompt=\" \", output_path=os.path.join(wav_path, \"{wav_name}\"))')
-                code_block_one.append(f'torch.cuda.empty_cache()')
-            elif audio_type == 'music':
-                code_block_one.append(f'audio(prompt=\"{bg_audio["desc"]}\", volume={bg_audio["vol"]}, duration={A_len}, negative_prompt=\" \", output_path=os.path.join(wav_path, \"{wav_name}\"))')
-                code_block_one.append(f'torch.cuda.empty_cache()')
+            if audio_type in ['sound_effect', 'music']:
+                code_block_one.append(f'dict(kind=\"audio\", prompt=\"{bg_audio["desc"]}\", volume={bg_audio["vol"]}, duration={A_len}, negative_prompt=\" \"{quality_arg}, output_path=os.path.join(wav_path, \"{wav_name}\"))')
             else:
                 raise ValueError(f"Unsupported background audio_type: {audio_type}")
 
@@ -140,72 +164,44 @@ os.makedirs(wav_path, exist_ok=True)
                 'end_id': bg_audio['end_fg_audio_id']
             })
 
-        self.append_code("def function_one():")
-        self.append_code("    print(\"🚀 开始生成音效和背景音素材\")")
-        self.append_code("    start_time = time.time()")
-        for line in code_block_one:
-            self.append_code("    " + line)
-        self.append_code("    end_time = time.time()")
-        self.append_code("    print(f\"🎉 音效和背景音素材生成完成，耗时 {end_time - start_time:.2f} 秒\")")
-        self.append_code("\ndef function_two():")
-        self.append_code("    print(\"🚀 开始生成配音\")")
-        self.append_code("    start_time = time.time()")
-        for line in code_block_two:
-            self.append_code("    " + line)
-        self.append_code("    end_time = time.time()")
-        self.append_code("    print(f\"🎉 配音生成完成，耗时 {end_time - start_time:.2f} 秒\")")  
-
-
+        # 所有片段（音效/背景音种子与配音）交给 render_clips 并发请求，并发上限见 api.ASYNC_CONCURRENCY
+        self.append_code('clips = [')
+        for line in code_block_one + code_block_two:
+            self.append_code("    " + line + ",")
+        self.append_code(']')
         self.append_code('print("🚀 开始生成音频文件")')
         self.append_code('start_time = time.time()')
-        self.append_code('function_one()')
-        self.append_code('function_two()')
+        self.append_code('asyncio.run(render_clips(clips))')
+        self.append_code("print(f\"🎉 音效、背景音和配音素材生成完成，耗时 {time.time() - start_time:.2f} 秒\")")
         self.append_code('fg_audio_wavs = []')
-        self.append_code('fg_audio_lens = []')
         for wav in fg_audio_wavs:
             self.append_code(f'fg_audio_wavs.append(os.path.join(wav_path, \"{wav}\"))')
-            self.append_code(f'fg_audio_lens.append(COMPUTE_LEN(os.path.join(wav_path, \"{wav}\")))\n')
         self.append_code('CAT(wavs=fg_audio_wavs, out_wav=os.path.join(wav_path, \"foreground.wav\"))')
+        bg_spans = [(info['begin_id'], info['end_id']) for info in bg_audio_wav_info]
+        self.append_code(f'timeline = Timeline.from_wavs(fg_audio_wavs, {bg_spans})')
 
-        bg_audio_wavs = []
         self.append_code('print("🚀 开始处理背景音并生成混音")')
-        self.append_code('\nbg_audio_offsets = []')
-        for info in bg_audio_wav_info:
+        self.append_code('\nbg_audio_wav_offset_pairs = []')
+        for index, info in enumerate(bg_audio_wav_info):
             wav_name = info['wav_name']
-            begin_id = info['begin_id']
-            end_id = info['end_id']
-            self.append_code(f'bg_audio_len = sum(fg_audio_lens[{begin_id}:{end_id}])')
-            self.append_code(f'bg_audio_offset = sum(fg_audio_lens[:{begin_id}])')
-            # The audio() call is now in function_one. Here, we just LOOP the pre-generated file.
-            self.append_code(f'LOOP(os.path.join(wav_path, \"{wav_name}\"), os.path.join(wav_path, \"{wav_name}\"), bg_audio_len)')
-            
-            bg_audio_wavs.append(wav_name)
-            self.append_code('bg_audio_offsets.append(bg_audio_offset)\n')
-
-        self.append_code('bg_audio_wavs = []')
-        self.append_code('bg_audio_lens = []')
-        for wav in bg_audio_wavs:
-            self.append_code(f'bg_audio_wavs.append(os.path.join(wav_path, \"{wav}\"))')
-
-        self.append_code('bg_audio_wav_offset_pairs = list(zip(bg_audio_wavs, bg_audio_offsets))')
+            # 背景区间的起点与长度（整数采样点）由时间轴前缀和 O(1) 得到
+            self.append_code(f'bg_audio_offset, bg_audio_samples = timeline.span(*timeline.bg_spans[{index}])')
+            # The audio() call is now in the render_clips batch. Here, the seed clip is looped straight into the mix.
+            self.append_code(f'bg_audio_wav_offset_pairs.append((LoopSource(os.path.join(wav_path, \"{wav_name}\"), bg_audio_samples, sr=timeline.sr), bg_audio_offset))\n')
+
         self.append_code('bg_audio_wav_offset_pairs.append((os.path.join(wav_path, \"foreground.wav\"), 0))')
-        self.append_code(f'MIX(wavs=bg_audio_wav_offset_pairs, out_wav=os.path.join(wav_path, \"{result_filename}.wav\"))')
+        self.append_code(f'MIX(wavs=bg_audio_wav_offset_pairs, out_wav=os.path.join(wav_path, \"{result_filename}.wav\"), samples=True)')
         self.append_code("end_time = time.time()")
         self.append_code("print(f\"🎉 音频生成完成，耗时 {end_time - start_time:.2f} 秒\")")
     def init_char_to_voice_map(self, filename):
         with open(filename, 'r') as file:
             self.char_to_voice_map = json5.load(file)
 
-    def parse_and_generate(self, script_filename, char_to_voice_map_filename, output_path, result_filename='result'):
+    def parse_and_generate(self, script_filename, char_to_voice_map_filename, output_path, result_filename='result',
+                           quality=None):
         self.code = ''
         self.init_char_to_voice_map(char_to_voice_map_filename)
-        data = []
-        with open(script_filename, 'r') as file:
-            for line in file:
-                line = line.strip()
-                if line:
-                    json_object = json5.loads(line)
-                    data.append(json_object)
+        data = load_audio_script(script_filename)
         fg_audios, bg_audios = collect_and_check_audio_data(data)
-        self.generate_code(fg_audios, bg_audios, output_path, result_filename)
+        self.generate_code(fg_audios, bg_audios, output_path, result_filename, quality=quality)
         return self.code
\ No newline at end of file
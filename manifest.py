@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from cache import make_cache_key
+from code_generation import normalize_audio_type, resolve_voice
+
+MANIFEST_FILENAME = "render_manifest.json"
+JOURNAL_FILENAME = "render_journal.jsonl"
+REUSE_DIRNAME = ".reuse"
+DEFAULT_QUALITY = "final"  # 与服务端 services.DEFAULT_QUALITY 一致：quality=None 的请求按该档位生成
+
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+_voice_hashes = {}
+
+
+def _file_hash(path):
+    if path not in _voice_hashes:
+        _voice_hashes[path] = file_checksum(path)
+    return _voice_hashes[path]
+
+
+def clip_content_hash(audio, char_to_voice_map, seed_len=None, quality=None):
+    """
+    计算一个脚本条目渲染结果的内容哈希：只包含会影响生成音频的字段，
+    speech 额外包含参考音频内容与 prompt 文本，因此换声线也会触发重新生成；
+    音效/音乐包含 MMAudio 质量档位（None 按服务端默认档位计），draft 片段不会在 final 渲染中被复用。
+    """
+    audio_type = normalize_audio_type(audio['audio_type'])
+    if audio_type == 'speech':
+        prompt_text, ref_path = resolve_voice(char_to_voice_map, audio['character'])
+        ref_hash = _file_hash(ref_path) if os.path.exists(ref_path) else ref_path
+        return make_cache_key(audio_type, audio['text'], audio['vol'], prompt_text, ref_hash)
+    duration = seed_len if audio['layout'] == 'background' else audio['len']
+    return make_cache_key(audio_type, audio['layout'], audio['desc'], audio['vol'], duration, quality or DEFAULT_QUALITY)
+
+
+class RunJournal:
+    """
+    追加写的渲染日志：每完成一个片段写一行 {key, wav, len, sha256} 并 fsync。
+    清单（manifest）是检查点，日志记录检查点之后完成的片段，进程崩溃也不会丢失。
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+
+    def append(self, key, entry):
+        line = json.dumps({"key": key, **entry}, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self):
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # 崩溃时写了一半的最后一行
+                entries[record.pop("key")] = record
+        return entries
+
+    def truncate(self):
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class RunManifest:
+    """
+    每个输出目录一份的渲染清单：内容哈希 -> {wav: 相对 audio 目录的文件名, len: 秒}。
+
+    重跑时先把上次的片段挪到 audio/.reuse/<hash>.wav 暂存（避免新片段按序号命名时覆盖旧文件），
+    命中的条目直接从暂存区复制，未命中的才重新生成。
+    """
+
+    def __init__(self, path, entries=None, journal=None):
+        self.path = str(path)
+        self.entries = entries or {}
+        self.journal = journal
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, journal=None, wav_path=None, validate=False):
+        """
+        读取清单并合并日志中的记录。validate=True（--resume）时逐个校验 WAV 的 sha256，
+        丢弃缺失或内容不符的片段，只留下可以安全跳过的条目。
+        """
+        entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entries = json.load(f).get("clips", {})
+            except (OSError, ValueError) as e:
+                print(f"Warning: 无法读取渲染清单 {path}: {e}，将全量渲染。")
+        if journal is not None:
+            entries.update(journal.read())
+        if validate:
+            valid = {}
+            for key, entry in entries.items():
+                wav_file = os.path.join(wav_path, entry["wav"])
+                if os.path.exists(wav_file) and entry.get("sha256") == file_checksum(wav_file):
+                    valid[key] = entry
+            if len(valid) < len(entries):
+                print(f"Warning: {len(entries) - len(valid)} 个已记录片段缺失或校验失败，将重新生成。")
+            entries = valid
+        return cls(path, entries, journal)
+
+    def stage(self, wav_path):
+        """把清单中仍存在的片段移入暂存区，并立即落盘，保证中途崩溃后仍可复用。"""
+        reuse_dir = os.path.join(wav_path, REUSE_DIRNAME)
+        os.makedirs(reuse_dir, exist_ok=True)
+        staged = {}
+        for key, entry in self.entries.items():
+            src = os.path.join(wav_path, entry["wav"])
+            dst_name = os.path.join(REUSE_DIRNAME, f"{key}.wav")
+            dst = os.path.join(wav_path, dst_name)
+            if src != dst and os.path.exists(src):
+                os.replace(src, dst)
+            if os.path.exists(dst):
+                staged[key] = {**entry, "wav": dst_name}
+        self.entries = staged
+        self.save()
+
+    def lookup(self, key, wav_path):
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None or not os.path.exists(os.path.join(wav_path, entry["wav"])):
+            return None
+        return entry
+
+    def adopt(self, key, wav_path, wav_file):
+        """把暂存的片段复制到本次运行的文件名下，返回记录的时长。"""
+        entry = self.lookup(key, wav_path)
+        shutil.copyfile(os.path.join(wav_path, entry["wav"]), wav_file)
+        self.record(key, wav_path, wav_file, entry["len"])
+        return entry["len"]
+
+    def record(self, key, wav_path, wav_file, length):
+        entry = {"wav": os.path.relpath(wav_file, wav_path), "len": length, "sha256": file_checksum(wav_file)}
+        with self._lock:
+            self.entries[key] = entry
+            if self.journal is not None:
+                self.journal.append(key, entry)
+
+    def finalize(self, wav_path, keep):
+        """只保留本次运行用到的条目，并清理暂存区。"""
+        with self._lock:
+            self.entries = {key: entry for key, entry in self.entries.items()
+                            if key in keep and not entry["wav"].startswith(REUSE_DIRNAME)}
+        self.save()
+        shutil.rmtree(os.path.join(wav_path, REUSE_DIRNAME), ignore_errors=True)
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"clips": self.entries}, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # 清单已落盘，日志中的记录都已包含在内
+            if self.journal is not None:
+                self.journal.truncate()
@@ -0,0 +1,289 @@
+import math
+import os
+import random
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import soundfile as sf
+from scipy.signal import resample_poly
+
+SAMPLE_RATE = 24000
+MIX_BLOCK_SECONDS = 10.0   # 每次混合的输出块时长，决定混音的内存占用
+DECLIP_PEAK = 0.9          # 混音峰值超过 1 时整体缩放到该峰值
+PROBE_CACHE_SIZE = 4096    # 文件头缓存条目数上限
+LOOP_CROSSFADE_SECONDS = 0.5     # 背景音循环接缝处的等功率交叉淡化时长
+LOOP_FADE_RANGE = (2.5, 3.5)     # 背景音首尾渐入渐出时长的随机范围（秒）
+
+# (绝对路径, mtime_ns, 文件大小) -> (帧数, 采样率)；文件被改写后键随之变化，旧条目按 LRU 淘汰
+_probe_cache = OrderedDict()
+_probe_lock = threading.Lock()
+
+
+def _resample_ratio(orig_sr, sr):
+    g = math.gcd(orig_sr, sr)
+    return sr // g, orig_sr // g
+
+
+def probe_info(wav):
+    """只读文件头，返回 (帧数, 采样率)；结果按 (路径, mtime, 大小) 缓存。"""
+    stat = os.stat(wav)
+    key = (os.path.abspath(wav), stat.st_mtime_ns, stat.st_size)
+    with _probe_lock:
+        if key in _probe_cache:
+            _probe_cache.move_to_end(key)
+            return _probe_cache[key]
+    info = sf.info(wav)
+    value = (info.frames, info.samplerate)
+    with _probe_lock:
+        _probe_cache[key] = value
+        if len(_probe_cache) > PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return value
+
+
+def probe_length(wav, sr=SAMPLE_RATE):
+    """返回重采样到 sr 后的采样点数（与 resample_poly / torchaudio 重采样的输出长度一致），不解码音频。"""
+    frames, samplerate = probe_info(wav)
+    if samplerate == sr:
+        return frames
+    up, down = _resample_ratio(samplerate, sr)
+    return math.ceil(frames * up / down)
+
+
+class ClipReader:
+    """
+    按块顺序读取一个片段的第一声道，并流式重采样到 sr。
+
+    重采样按输入块进行，每块两侧各带 pad 个上下文采样点，pad 覆盖 resample_poly 的滤波器半长，
+    块边界与降采样因子对齐，因此拼接结果与整段 resample_poly 一致。
+    注意：原先整段读取时用的是 torchaudio.functional.resample（sinc 插值），与 resample_poly 的滤波器不同，
+    采样率不是 sr 的片段重采样后与旧版本输出有微小的数值差异（长度一致）。
+    """
+
+    def __init__(self, wav, sr=SAMPLE_RATE, block_size=None):
+        self._file = sf.SoundFile(wav)
+        self.length = probe_length(wav, sr)
+        self.up, self.down = _resample_ratio(self._file.samplerate, sr)
+        self._resample = self._file.samplerate != sr
+        self._buffer = np.zeros(0, dtype=np.float32)  # 已重采样、尚未读出的输出
+        self._produced = 0
+        if self._resample:
+            # resample_poly 的滤波器半长为 10 * max(up, down)（上采样域），换算到输入采样点
+            half = 10 * max(self.up, self.down) / self.up + 1
+            self._pad = self.down * math.ceil(half / self.down)
+            chunk = block_size or int(MIX_BLOCK_SECONDS * self._file.samplerate)
+            self._chunk = self.down * max(1, chunk // self.down)
+            # 左侧上下文：文件开头之前视为 0，与 resample_poly 的零填充一致
+            self._window = np.zeros(self._pad, dtype=np.float32)
+        self._eof = False
+
+    def _read_input(self, frames):
+        data = self._file.read(frames, dtype='float32', always_2d=True)
+        if len(data) < frames:
+            self._eof = True
+        return data[:, 0]
+
+    def _fill(self, n):
+        while len(self._buffer) < n and self._produced < self.length:
+            if not self._resample:
+                out = self._read_input(n - len(self._buffer))
+                if len(out) == 0:
+                    break
+            else:
+                need = self._pad + self._chunk + self._pad - len(self._window)
+                if need > 0 and not self._eof:
+                    self._window = np.concatenate([self._window, self._read_input(need)])
+                window = self._window
+                if len(window) < 2 * self._pad + self._chunk:
+                    window = np.pad(window, (0, 2 * self._pad + self._chunk - len(window)))
+                start = self._pad * self.up // self.down
+                out = resample_poly(window, self.up, self.down)[start:start + self._chunk * self.up // self.down]
+                self._window = self._window[self._chunk:]
+            out = out[:self.length - self._produced].astype(np.float32, copy=False)
+            self._produced += len(out)
+            self._buffer = np.concatenate([self._buffer, out])
+
+    def read(self, n):
+        """读出接下来的 n 个采样点，片段结束后补 0。"""
+        self._fill(n)
+        out, self._buffer = self._buffer[:n], self._buffer[n:]
+        if len(out) < n:
+            out = np.pad(out, (0, n - len(out)))
+        return out
+
+    def close(self):
+        self._file.close()
+
+
+def _equal_power(n):
+    """长度为 n 的等功率交叉淡化曲线 (fade_in, fade_out)，两者平方和恒为 1。"""
+    t = (np.arange(n, dtype=np.float32) + 0.5) / max(n, 1)
+    return np.sin(t * np.pi / 2), np.cos(t * np.pi / 2)
+
+
+class LoopSource:
+    """
+    把种子片段循环到 length 个采样点的背景音床，可直接作为 stream_mix 的片段按块生成，
+    不写中间文件，也不展开整段音床。
+
+    长度不超过种子时直接截断；否则以 len(seed) - crossfade 为周期重复，每个接缝处
+    上一周期的尾部与下一周期的开头做等功率交叉淡化。首尾加线性渐入渐出，
+    未指定时长时在 LOOP_FADE_RANGE 内随机选取。
+    """
+
+    def __init__(self, seed, length, sr=SAMPLE_RATE, crossfade=LOOP_CROSSFADE_SECONDS, fade_in=None, fade_out=None):
+        """
+        Args:
+            seed: 种子片段的路径（读取第一声道并重采样到 sr），或单声道 float 数组。
+            length (int): 音床长度（采样点）。
+            sr (int): 采样率。
+            crossfade (float): 接缝交叉淡化时长（秒），不超过种子长度的一半。
+            fade_in / fade_out (float): 渐入 / 渐出时长（秒），不超过音床长度的一半。
+        """
+        if isinstance(seed, str):
+            reader = ClipReader(seed, sr)
+            try:
+                seed = reader.read(reader.length)
+            finally:
+                reader.close()
+        seed = np.asarray(seed, dtype=np.float32)
+        if len(seed) == 0:
+            raise ValueError("LoopSource needs a non-empty seed clip")
+        self.sr = sr
+        self.length = int(length)
+        self._position = 0
+
+        n = len(seed)
+        overlap = min(int(crossfade * sr), n // 2)
+        self._seed = seed
+        self._period = n - overlap
+        # 第二个周期起的内容：开头 overlap 个采样点是上一周期尾部与种子开头的交叉淡化
+        fade_in_curve, fade_out_curve = _equal_power(overlap)
+        self._unit = seed[:self._period].copy()
+        self._unit[:overlap] = seed[:overlap] * fade_in_curve + seed[self._period:] * fade_out_curve
+        # 不需要循环时第一段就是整个种子
+        self._head = n if self.length <= n else self._period
+
+        if fade_in is None:
+            fade_in = random.uniform(*LOOP_FADE_RANGE)
+        if fade_out is None:
+            fade_out = random.uniform(*LOOP_FADE_RANGE)
+        self._fade_in = min(int(fade_in * sr), self.length // 2)
+        self._fade_out = min(int(fade_out * sr), self.length // 2)
+
+    def render(self, start, n):
+        """音床 [start, start + n) 段的采样点（超出 length 的部分为 0）。"""
+        idx = np.arange(start, start + n, dtype=np.int64)
+        out = np.zeros(n, dtype=np.float32)
+        inside = idx < self.length
+        head = inside & (idx < self._head)
+        tail = inside & ~head
+        out[head] = self._seed[idx[head]]
+        out[tail] = self._unit[(idx[tail] - self._head) % self._period]
+
+        gain = np.ones(n, dtype=np.float32)
+        if self._fade_in:
+            gain = np.minimum(gain, idx / self._fade_in)
+        if self._fade_out:
+            gain = np.minimum(gain, (self.length - idx) / self._fade_out)
+        return out * np.clip(gain, 0.0, 1.0)
+
+    def read(self, n):
+        out = self.render(self._position, n)
+        self._position += n
+        return out
+
+    def close(self):
+        pass
+
+
+def stream_mix(clips, out_wav, sr=SAMPLE_RATE, subtype='PCM_16', block_seconds=MIX_BLOCK_SECONDS):
+    """
+    流式混音：按固定长度的输出块把各片段叠加，内存占用与总时长无关。
+
+    第一遍逐块混合并写入临时 float32 文件、记录峰值；第二遍按峰值缩放（削波处理）
+    后逐块写出 out_wav。只有与当前块重叠的片段处于打开状态。
+
+    Args:
+        clips: [(wav 路径或 LoopSource, 起始采样点), ...]，采样点以 sr 计。
+        out_wav (str): 输出路径。
+        sr (int): 输出采样率。
+        subtype (str): 输出格式，'PCM_16' 或 'FLOAT'。
+        block_seconds (float): 每块时长（秒）。
+    """
+    block = max(1, int(block_seconds * sr))
+    placed = sorted(
+        ((int(offset), wav.length if isinstance(wav, LoopSource) else probe_length(wav, sr), wav)
+         for wav, offset in clips),
+        key=lambda clip: clip[0],
+    )
+    total = max((offset + length for offset, length, _ in placed), default=0)
+
+    out_dir = os.path.dirname(os.path.abspath(out_wav))
+    fd, tmp_path = tempfile.mkstemp(suffix='.f32', dir=out_dir)
+    active = []   # [(起始采样点, 长度, ClipReader)]
+    try:
+        # 第一遍：逐块混合
+        peak = 0.0
+        next_clip = 0
+        with os.fdopen(fd, 'wb') as tmp:
+            for block_start in range(0, total, block):
+                block_end = min(block_start + block, total)
+                while next_clip < len(placed) and placed[next_clip][0] < block_end:
+                    offset, length, wav = placed[next_clip]
+                    reader = wav if isinstance(wav, LoopSource) else ClipReader(wav, sr, block_size=block)
+                    active.append((offset, length, reader))
+                    next_clip += 1
+
+                mixed = np.zeros(block_end - block_start, dtype=np.float32)
+                still_active = []
+                for offset, length, reader in active:
+                    lo = max(block_start, offset)
+                    hi = min(block_end, offset + length)
+                    if hi > lo:
+                        mixed[lo - block_start:hi - block_start] += reader.read(hi - lo)
+                    if offset + length > block_end:
+                        still_active.append((offset, length, reader))
+                    else:
+                        reader.close()
+                active = still_active
+
+                if len(mixed):
+                    peak = max(peak, float(np.max(np.abs(mixed))))
+                tmp.write(mixed.tobytes())
+
+        # 第二遍：削波缩放并写出
+        gain = DECLIP_PEAK / peak if peak > 1 else 1.0
+        with sf.SoundFile(out_wav, 'w', samplerate=sr, channels=1, subtype=subtype) as out, \
+                open(tmp_path, 'rb') as tmp:
+            while True:
+                mixed = np.fromfile(tmp, dtype=np.float32, count=block)
+                if len(mixed) == 0:
+                    break
+                mixed *= gain
+                if subtype == 'PCM_16':
+                    out.write(np.round(mixed * 32767).astype(np.int16))
+                else:
+                    out.write(mixed)
+    finally:
+        for _, _, reader in active:
+            reader.close()
+        os.remove(tmp_path)
+    return out_wav
+
+
+def stream_cat(wavs, out_wav, sr=SAMPLE_RATE, subtype='PCM_16'):
+    """
+    顺序拼接：由文件头长度算出每个片段的起始采样点，再交给 stream_mix，
+    每个片段只解码、写入一次，总耗时与总时长成线性关系。
+
+    Returns:
+        list: 每个片段在输出中的起始采样点（以 sr 计），末尾追加总长度。
+    """
+    offsets = [0]
+    for wav in wavs:
+        offsets.append(offsets[-1] + probe_length(wav, sr))
+    stream_mix(list(zip(wavs, offsets)), out_wav, sr=sr, subtype=subtype)
+    return offsets
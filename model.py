@@ -6,6 +6,8 @@ from einops import rearrange
 import soundfile as sf 
 import pyloudnorm as pyln
 import numpy as np
+from collections import deque
+from scipy.signal import lfilter
 from vllm import ModelRegistry
 from tqdm import tqdm
 from utils import LOUDNESS_NORM
@@ -18,6 +20,8 @@ from cosyvoice.vllm.cosyvoice2 import CosyVoice2ForCausalLM
 ModelRegistry.register_model("CosyVoice2ForCausalLM", CosyVoice2ForCausalLM)
 from cosyvoice.utils.common import set_all_random_seed
 import logging
+import threading
+from collections import OrderedDict
 from pathlib import Path
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"使用的设备: {device}")
@@ -40,41 +44,117 @@ def load_cosyvoice_model(model_path='TTS/CosyVoice/pretrained_models/CosyVoice2-
 
 
 
+class SpeakerRegistry:
+    """
+    说话人注册表：每个参考音色只提取一次 CosyVoice 前端特征（prompt 文本/语音 token、
+    speaker embedding、mel 特征），以 speaker_id 存入 frontend.spk2info。
+
+    内存中按 LRU 最多保留 max_speakers 个音色，同时把特征持久化为 <cache_dir>/<speaker_id>.npz，
+    被淘汰或服务重启后可直接从 npz 恢复，无需重新提取。
+    """
+
+    def __init__(self, model, cache_dir, max_speakers=64):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.max_speakers = max_speakers
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def npz_path(self, speaker_id):
+        return os.path.join(self.cache_dir, f"{speaker_id}.npz")
+
+    def _touch(self, speaker_id):
+        self._loaded[speaker_id] = True
+        self._loaded.move_to_end(speaker_id)
+        while len(self._loaded) > self.max_speakers:
+            evicted, _ = self._loaded.popitem(last=False)
+            self.model.frontend.spk2info.pop(evicted, None)
+
+    def register(self, speaker_id, prompt_text, prompt_speech_16k):
+        """提取并缓存特征，返回 npz 路径。prompt_speech_16k 为音频文件路径或文件对象。"""
+        with self._lock:
+            if speaker_id not in self._loaded and not self._load_npz(speaker_id):
+                print(f"[CosyVoice2] 注册说话人 {speaker_id}")
+                self.model.add_zero_shot_spk(prompt_text, load_wav(prompt_speech_16k, 16000), speaker_id)
+                features = self.model.frontend.spk2info[speaker_id]
+                np.savez(self.npz_path(speaker_id), **{k: v.cpu().numpy() for k, v in features.items()})
+            self._touch(speaker_id)
+        return self.npz_path(speaker_id)
+
+    def _load_npz(self, speaker_id):
+        npz_path = self.npz_path(speaker_id)
+        if not os.path.exists(npz_path):
+            return False
+        with np.load(npz_path) as features:
+            self.model.frontend.spk2info[speaker_id] = {
+                k: torch.from_numpy(features[k]).to(self.model.frontend.device) for k in features.files
+            }
+        return True
+
+    def ensure_loaded(self, speaker_id):
+        """确保 speaker_id 的特征在内存中；未注册过返回 False。"""
+        with self._lock:
+            if speaker_id not in self._loaded and not self._load_npz(speaker_id):
+                return False
+            self._touch(speaker_id)
+            return True
+
+
+def tts_waveform(model, tts_text, prompt_text, prompt_speech_16k, speed=1.0, normalize=True, volume=-23.0,
+                 peak_norm_db_for_norm=-1.0, zero_shot_spk_id=''):
+    """
+    生成整段语音并返回 (1, samples) 的 float32 张量（采样率 model.sample_rate），未生成任何音频时返回 None。
+    prompt_speech_16k 可以是音频文件路径或文件对象；出错时直接抛出异常。
+    """
+    if zero_shot_spk_id:
+        # 使用 SpeakerRegistry 预先提取的特征，跳过参考音频的加载与特征提取
+        prompt_text, prompt_speech_16k = '', ''
+    else:
+        prompt_speech_16k = load_wav(prompt_speech_16k, 16000)
+
+    all_audio = []
+    for i, j in enumerate(model.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id=zero_shot_spk_id,
+                                                    stream=False, speed=speed, text_frontend=True)):
+
+        speech_tensor = j['tts_speech']  # (1, samples)
+
+        if normalize:
+            audio_np = speech_tensor.cpu().numpy()  # (1, samples)
+            normalized_audio_np = LOUDNESS_NORM(audio_np, sr=model.sample_rate,
+                                                target_lufs=volume, peak_norm_db=peak_norm_db_for_norm)
+            final_tensor = torch.from_numpy(normalized_audio_np).to(torch.float32)
+            print(f"[CosyVoice2] [{i}] 响度归一化完成")
+        else:
+            final_tensor = speech_tensor.cpu()
+            print(f"[CosyVoice2] [{i}] 未进行响度归一化")
+
+        final_tensor = final_tensor.clamp(-1, 1)  # 安全限制幅度
+        all_audio.append(final_tensor)
+
+    if not all_audio:
+        return None
+
+    # 拼接所有段：按时间顺序拼接 along time dimension (dim=1)
+    return torch.cat(all_audio, dim=1)  # (1, total_samples)
+
+
 def tts(model, tts_text, prompt_text, prompt_speech_16k, out_wav="output_cosyvoice.wav", speed=1.0,
-        normalize=True, volume=-23.0, peak_norm_db_for_norm=-1.0):
+        normalize=True, volume=-23.0, peak_norm_db_for_norm=-1.0, zero_shot_spk_id=''):
     if model is None:
         print("[CosyVoice2] 模型未加载，跳过生成。")
         return
 
     print(f"[CosyVoice2] 开始生成TTS，文本: '{tts_text[:30]}...'")
-    prompt_speech_16k = load_wav(prompt_speech_16k, 16000)
     try:
-        all_audio = []
-
-        for i, j in enumerate(model.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, stream=False, speed=speed, text_frontend=True)):
-            
-            speech_tensor = j['tts_speech']  # (1, samples)
-
-            if normalize:
-                audio_np = speech_tensor.cpu().numpy()  # (1, samples)
-                normalized_audio_np = LOUDNESS_NORM(audio_np, sr=model.sample_rate,
-                                                    target_lufs=volume, peak_norm_db=peak_norm_db_for_norm)
-                final_tensor = torch.from_numpy(normalized_audio_np).to(torch.float32)
-                print(f"[CosyVoice2] [{i}] 响度归一化完成")
-            else:
-                final_tensor = speech_tensor.cpu()
-                print(f"[CosyVoice2] [{i}] 未进行响度归一化")
-
-            final_tensor = final_tensor.clamp(-1, 1)  # 安全限制幅度
-            all_audio.append(final_tensor)
-
-        if not all_audio:
+        combined_audio = tts_waveform(model, tts_text, prompt_text, prompt_speech_16k, speed=speed,
+                                      normalize=normalize, volume=volume,
+                                      peak_norm_db_for_norm=peak_norm_db_for_norm,
+                                      zero_shot_spk_id=zero_shot_spk_id)
+        if combined_audio is None:
             print("[CosyVoice2] 未生成任何音频段。")
             return
 
-        # 拼接所有段：按时间顺序拼接 along time dimension (dim=1)
-        combined_audio = torch.cat(all_audio, dim=1)  # (1, total_samples)
-
         torchaudio.save(out_wav, combined_audio, model.sample_rate)
         print(f"[CosyVoice2] 音频已拼接并保存为: {out_wav}")
 
@@ -83,6 +163,162 @@ def tts(model, tts_text, prompt_text, prompt_speech_16k, out_wav="output_cosyvoi
         import traceback
         traceback.print_exc()
 
+STREAM_LOUDNESS_MIN_SECONDS = 0.4  # pyloudnorm 的门限块长度，累计音频短于此无法测量响度
+LOUDNESS_STEP_SECONDS = 0.1        # BS.1770 门限块步长（400ms 块、75% 重叠）
+LOUDNESS_HIST_MIN, LOUDNESS_HIST_MAX, LOUDNESS_HIST_STEP = -70.0, 10.0, 0.1  # 块响度直方图范围（LUFS）
+
+
+class IncrementalLoudness:
+    """
+    增量计算 BS.1770 积分响度（与 pyloudnorm.Meter 相同的 K 加权与 -70 LUFS / -10 LU 双重门限）。
+
+    K 加权滤波保留 IIR 状态逐块进行，每 100ms 累加一次平方和，凑满 400ms 得到一个门限块；
+    门限块按响度放入 0.1 LU 的直方图并累计能量，相对门限只需扫描固定大小的直方图，
+    因此每块的代价与已生成音频的总长无关（相对门限的精度为一个直方图格）。
+    """
+
+    def __init__(self, meter):
+        # pyloudnorm 的滤波级（高架 + 高通），按相同顺序带状态地应用
+        self._filters = [
+            [stage.b, stage.a, stage.passband_gain, np.zeros(max(len(stage.a), len(stage.b)) - 1)]
+            for stage in meter._filters.values()
+        ]
+        self._step = int(round(LOUDNESS_STEP_SECONDS * meter.rate))
+        self._block = 4 * self._step
+        self._partial = 0.0     # 当前 100ms 步内已累计的平方和
+        self._partial_len = 0
+        self._steps = deque(maxlen=4)
+        bins = int(round((LOUDNESS_HIST_MAX - LOUDNESS_HIST_MIN) / LOUDNESS_HIST_STEP))
+        self._counts = np.zeros(bins, dtype=np.int64)
+        self._energy = np.zeros(bins, dtype=np.float64)
+
+    def add(self, chunk):
+        y = np.asarray(chunk, dtype=np.float64)
+        for stage in self._filters:
+            b, a, gain, zi = stage
+            y, stage[3] = lfilter(b, a, y, zi=zi)
+            y = y * gain
+        squares = y * y
+
+        pos = 0
+        while pos < len(squares):
+            take = min(self._step - self._partial_len, len(squares) - pos)
+            self._partial += float(np.sum(squares[pos:pos + take]))
+            self._partial_len += take
+            pos += take
+            if self._partial_len == self._step:
+                self._steps.append(self._partial)
+                self._partial, self._partial_len = 0.0, 0
+                if len(self._steps) == 4:
+                    self._add_block(sum(self._steps) / self._block)
+
+    def _add_block(self, energy):
+        if energy <= 0:
+            return
+        block_lufs = -0.691 + 10.0 * np.log10(energy)
+        if block_lufs < LOUDNESS_HIST_MIN:  # 绝对门限
+            return
+        index = min(int((block_lufs - LOUDNESS_HIST_MIN) / LOUDNESS_HIST_STEP), len(self._counts) - 1)
+        self._counts[index] += 1
+        self._energy[index] += energy
+
+    def loudness(self):
+        """当前积分响度（LUFS）；没有通过门限的块时为 -inf。"""
+        count = self._counts.sum()
+        if count == 0:
+            return float('-inf')
+        relative_gate = -0.691 + 10.0 * np.log10(self._energy.sum() / count) - 10.0
+        start = max(0, int(np.floor((relative_gate - LOUDNESS_HIST_MIN) / LOUDNESS_HIST_STEP)))
+        count = self._counts[start:].sum()
+        if count == 0:
+            return float('-inf')
+        return float(-0.691 + 10.0 * np.log10(self._energy[start:].sum() / count))
+
+
+class StreamingLoudness:
+    """
+    流式响度归一化：增益由已生成音频的累计积分响度决定。首个可测量的块给出初始增益，
+    之后每块按累计响度修正；块内增益线性过渡到新值，避免修正时产生跳变。
+    累计响度由 IncrementalLoudness 增量维护，每块的代价与段落总长无关。
+    """
+
+    def __init__(self, sample_rate, target_lufs=-23.0, peak_norm_db=-1.0):
+        self.sample_rate = sample_rate
+        self.target_lufs = target_lufs
+        self.peak_norm_db = peak_norm_db
+        self.meter = pyln.Meter(sample_rate)
+        self._integrator = IncrementalLoudness(self.meter)
+        self._samples = 0   # 已输入的原始音频长度
+        self._pending = []  # 尚不足以测量响度、暂缓输出的块
+        self._gain = None
+
+    def process(self, chunk):
+        """输入一块 (samples,) 原始音频，返回归一化后的音频；仍在等待首次测量时返回 None。"""
+        self._integrator.add(chunk)
+        self._samples += len(chunk)
+        self._pending.append(chunk)
+        if self._samples < STREAM_LOUDNESS_MIN_SECONDS * self.sample_rate:
+            return None
+        loudness = self._integrator.loudness()
+        if np.isfinite(loudness):
+            target_gain = 10.0 ** ((self.target_lufs - loudness) / 20.0)
+        else:
+            # 目前为止全是静音：沿用已有增益
+            target_gain = self._gain if self._gain is not None else 1.0
+        start_gain = self._gain if self._gain is not None else target_gain
+        self._gain = target_gain
+
+        out = np.concatenate(self._pending)
+        self._pending = []
+        ramp = np.linspace(start_gain, target_gain, len(out), dtype=np.float32)
+        return np.clip(out * ramp, -1.0, 1.0).astype(np.float32)
+
+    def flush(self):
+        """输出剩余的块；整段都过短无法测量时与 LOUDNESS_NORM 一样只做峰值归一化。"""
+        if not self._pending:
+            return None
+        out = np.concatenate(self._pending)
+        self._pending = []
+        if self._gain is None:
+            out = pyln.normalize.peak(out, self.peak_norm_db)
+        else:
+            out = out * self._gain
+        return np.clip(out, -1.0, 1.0).astype(np.float32)
+
+
+def tts_stream(model, tts_text, prompt_text, prompt_speech_16k, speed=1.0, normalize=True, volume=-23.0,
+               peak_norm_db_for_norm=-1.0, zero_shot_spk_id=''):
+    """
+    tts() 的流式版本：使用 CosyVoice 的 stream 模式，逐块产出 (samples,) float32 音频，
+    采样率为 model.sample_rate。响度按 StreamingLoudness 增量归一化。
+    """
+    if model is None:
+        print("[CosyVoice2] 模型未加载，跳过生成。")
+        return
+
+    print(f"[CosyVoice2] 开始流式生成TTS，文本: '{tts_text[:30]}...'")
+    if zero_shot_spk_id:
+        prompt_text, prompt_speech_16k = '', ''
+    else:
+        prompt_speech_16k = load_wav(prompt_speech_16k, 16000)
+
+    loudness = StreamingLoudness(model.sample_rate, volume, peak_norm_db_for_norm) if normalize else None
+    for j in model.inference_zero_shot(tts_text, prompt_text, prompt_speech_16k, zero_shot_spk_id=zero_shot_spk_id,
+                                       stream=True, speed=speed, text_frontend=True):
+        chunk = j['tts_speech'].cpu().numpy()[0].astype(np.float32)  # (samples,)
+        if loudness is not None:
+            chunk = loudness.process(chunk)
+            if chunk is None:
+                continue
+        else:
+            chunk = np.clip(chunk, -1.0, 1.0)
+        yield chunk
+
+    if loudness is not None:
+        tail = loudness.flush()
+        if tail is not None:
+            yield tail
+
 # ------------------------------
 # 主执行逻辑
 # ------------------------------
@@ -1,10 +1,15 @@
 from pathlib import Path
-from code_generation import AudioCodeGenerator
+from code_generation import AudioCodeGenerator, collect_and_check_audio_data, load_audio_script
+from scheduler import RenderScheduler
+from manifest import RunManifest, RunJournal, MANIFEST_FILENAME, JOURNAL_FILENAME
+from cache import DiskLRUCache, make_cache_key
+from streaming import JSON5ObjectSplitter, StreamingScriptRenderer
 from openai import OpenAI
-from api import rag
+from api import rag, configure_endpoints
 import json
 import json5
 import argparse
+import hashlib
 import os
 import re
 import time
@@ -67,25 +72,93 @@ def _temp_proxy_env(proxy_url: str):
             os.environ.pop("https_proxy", None)
 
 
-def chat_with_gpt(input_text):
-    """Call OpenAI GPT with optional proxy settings."""
+# --- LLM Response Cache ---
+# 以 (模型, prompt 模板哈希, 完整 prompt, 采样参数) 为键缓存 GPT 响应，TTL 过期 + 按字节 LRU 淘汰
+LLM_MODEL = "gpt-4.1"
+LLM_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'llm')
+LLM_CACHE_MAX_BYTES = 256 * 2**20
+LLM_CACHE_TTL = 7 * 24 * 3600  # 秒
+LLM_CACHE_ENABLED = True  # --no_llm_cache 时关闭读取，仅刷新缓存
+_llm_cache = None
+
+
+def get_llm_cache():
+    global _llm_cache
+    if _llm_cache is None:
+        _llm_cache = DiskLRUCache(LLM_CACHE_DIR, LLM_CACHE_MAX_BYTES, suffix='.json')
+    return _llm_cache
+
+
+def chat_with_gpt(input_text, template_hash=None, model=LLM_MODEL, **sampling_params):
+    """Call OpenAI GPT with optional proxy settings, memoized on disk."""
+    cache = get_llm_cache()
+    cache_key = make_cache_key(model, template_hash, input_text, sampling_params)
+    if LLM_CACHE_ENABLED:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            entry = json.loads(cached.decode('utf-8'))
+            if time.time() - entry["created_at"] <= LLM_CACHE_TTL:
+                print("♻️ 命中 LLM 响应缓存")
+                return entry["output_text"]
+            cache.delete(cache_key)
+
     with _temp_proxy_env(OPENAI_PROXY):
         client = OpenAI()
         response = client.responses.create(
-            model="gpt-4.1",
+            model=model,
+            input=input_text,
+            **sampling_params,
+        )
+        output_text = response.output_text
+
+    entry = {"created_at": time.time(), "model": model, "output_text": output_text}
+    cache.put(cache_key, json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+    return output_text
+
+def stream_chat_with_gpt(input_text, template_hash=None, model=LLM_MODEL, **sampling_params):
+    """Streaming variant of chat_with_gpt: yields text deltas as they arrive."""
+    cache = get_llm_cache()
+    cache_key = make_cache_key(model, template_hash, input_text, sampling_params)
+    if LLM_CACHE_ENABLED:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            entry = json.loads(cached.decode('utf-8'))
+            if time.time() - entry["created_at"] <= LLM_CACHE_TTL:
+                print("♻️ 命中 LLM 响应缓存")
+                yield entry["output_text"]
+                return
+            cache.delete(cache_key)
+
+    chunks = []
+    with _temp_proxy_env(OPENAI_PROXY):
+        client = OpenAI()
+        stream = client.responses.create(
+            model=model,
             input=input_text,
+            stream=True,
+            **sampling_params,
         )
-        return response.output_text
+        for event in stream:
+            if event.type == "response.output_text.delta":
+                chunks.append(event.delta)
+                yield event.delta
+
+    entry = {"created_at": time.time(), "model": model, "output_text": "".join(chunks)}
+    cache.put(cache_key, json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+
+def get_template_hash(template):
+    return hashlib.sha256(template.encode('utf-8')).hexdigest()
 
 def generate_Step1(topic, output_path):
     print("🔍 【Step1】生成对话脚本 ...")
     
     # 1. 构建完整 prompt（读取模板 + 换行 + topic）
     complete_prompt_path = f'prompts/Step1.prompt'
-    complete_prompt = get_file_content(complete_prompt_path) + "\n" + topic
+    template = get_file_content(complete_prompt_path)
+    complete_prompt = template + "\n" + topic
 
     # 2. 获取 GPT 响应
-    json_response = try_extract_content_from_quotes(chat_with_gpt(complete_prompt))
+    json_response = try_extract_content_from_quotes(chat_with_gpt(complete_prompt, template_hash=get_template_hash(template)))
 
     # 3. 保存原始 GPT 响应
     raw_save_path = f'{output_path}/Step1_output.json'
@@ -98,19 +171,66 @@ def generate_Step2(text, output_path ):
     
     # 1. 构建完整 prompt（读取模板 + 换行 + topic）
     complete_prompt_path = f'prompts/Step2.prompt'
-    complete_prompt = get_file_content(complete_prompt_path) + "\n" + text
+    template = get_file_content(complete_prompt_path)
+    complete_prompt = template + "\n" + text
 
     # 2. 获取 GPT 响应
-    json_response = try_extract_content_from_quotes(chat_with_gpt(complete_prompt))
+    json_response = try_extract_content_from_quotes(chat_with_gpt(complete_prompt, template_hash=get_template_hash(template)))
     print(json_response)
     # 3. 保存原始 GPT 响应
     return json_response
 
+def generate_Step2_streaming(text, output_path, doc_file_path, tts_concurrency=1, audio_concurrency=1,
+                             result_filename="final_mix", incremental=True, quality=None):
+    """边接收 Step2 LLM 输出边合成：完整的条目一到达就送入调度器。"""
+    print("🔍 【Step2】流式生成配音脚本并同步合成 ...")
+
+    complete_prompt_path = f'prompts/Step2.prompt'
+    template = get_file_content(complete_prompt_path)
+    complete_prompt = template + "\n" + text
+
+    output_dir_path = Path(output_path)
+    scheduler = RenderScheduler(
+        wav_path=output_dir_path.absolute() / "audio",
+        char_to_voice_map={},
+        tts_concurrency=tts_concurrency,
+        audio_concurrency=audio_concurrency,
+        manifest=load_manifest(output_dir_path, incremental),
+        quality=quality,
+    )
+    renderer = StreamingScriptRenderer(scheduler, doc_file_path, output_dir_path)
+    splitter = JSON5ObjectSplitter()
+
+    start_time = time.time()
+    try:
+        for delta in stream_chat_with_gpt(complete_prompt, template_hash=get_template_hash(template)):
+            renderer.feed(splitter, delta)
+    except Exception:
+        renderer.close()
+        scheduler.shutdown()
+        raise
+    renderer.close()
+    print(f"✅ 【Step2】配音脚本接收完成，共 {len(renderer.items)} 条，耗时 {time.time() - start_time:.2f} 秒")
+
+    # 与非流式流程保持一致的落盘产物
+    json5l_path = os.path.join(output_path, "Step2.jsonl")
+    write_to_json5l(process_audio_data(renderer.items), json5l_path)
+    char_map_path = os.path.join(output_path, "match_results.json")
+    with open(char_map_path, 'w', encoding='utf-8') as f:
+        json.dump(renderer.char_to_voice_map, f, ensure_ascii=False, indent=2)
+
+    return scheduler.finish(result_filename)
+
 def generate_and_run_audio_script(
     script_path: str,
     char_map_path: str,
     output_dir: str = "output1",
-    result_filename: str = "final_mix"
+    result_filename: str = "final_mix",
+    tts_concurrency: int = 1,
+    audio_concurrency: int = 1,
+    incremental: bool = True,
+    resume: bool = False,
+    quality: str = None,
 ):
     # 初始化生成器
     generator = AudioCodeGenerator()
@@ -124,7 +244,8 @@ def generate_and_run_audio_script(
         script_filename=Path(script_path),
         char_to_voice_map_filename=Path(char_map_path),
         output_path=output_dir_path,
-        result_filename=result_filename
+        result_filename=result_filename,
+        quality=quality,
     )
 
     # 保存生成代码
@@ -134,11 +255,37 @@ def generate_and_run_audio_script(
 
     print("🎉 配音脚本生成完成！")
 
-    # 执行生成的配音脚本
-    print("✅ 开始运行生成的配音脚本...")
-    with generated_code_path.open("r", encoding="utf-8") as f:
-        generated_code = f.read()
-    exec(generated_code, {"time": time})
+    # 在进程内调度执行：TTS 与 MMAudio 两条流水线并发，生成代码仅作留档
+    print("✅ 开始调度音频合成...")
+    fg_audios, bg_audios = collect_and_check_audio_data(load_audio_script(Path(script_path)))
+    scheduler = RenderScheduler(
+        wav_path=output_dir_path.absolute() / "audio",
+        char_to_voice_map=generator.char_to_voice_map,
+        tts_concurrency=tts_concurrency,
+        audio_concurrency=audio_concurrency,
+        manifest=load_manifest(output_dir_path, incremental, resume),
+        quality=quality,
+    )
+    return scheduler.run(fg_audios, bg_audios, result_filename=result_filename)
+
+def load_manifest(output_dir_path, incremental=True, resume=False):
+    """
+    读取输出目录下的渲染清单与日志；关闭增量渲染时从空清单开始（仍会写出新清单）。
+    resume=True 时校验每个已记录 WAV 的 sha256，只调度缺失或损坏的片段。
+    """
+    manifest_path = Path(output_dir_path) / MANIFEST_FILENAME
+    journal = RunJournal(Path(output_dir_path) / JOURNAL_FILENAME)
+    if not incremental:
+        return RunManifest(manifest_path, journal=journal)
+    manifest = RunManifest.load(
+        manifest_path,
+        journal=journal,
+        wav_path=Path(output_dir_path).absolute() / "audio",
+        validate=resume,
+    )
+    if manifest.entries:
+        print(f"♻️ 找到已渲染片段记录，共 {len(manifest.entries)} 个片段可供复用")
+    return manifest
 
 def process_audio_data(data_list):
     import copy
@@ -242,11 +389,54 @@ if __name__ == "__main__":
     parser.add_argument("--step1", type=str, help="Step1 output JSON 文件的路径，如果提供则跳过Step1生成")
     parser.add_argument("--step2", type=str, help="Step2 output JSONL 文件的路径，如果提供则跳过Step1和Step2生成")
     parser.add_argument("--output_path", type=str, default="output1", help="输出目录")
+    parser.add_argument("--tts_concurrency", type=int, default=1, help="TTS 请求并发上限")
+    parser.add_argument("--audio_concurrency", type=int, default=1, help="MMAudio 请求并发上限")
+    parser.add_argument("--quality", type=str, choices=["draft", "final"], default="final",
+                        help="音效/音乐的 MMAudio 质量档位：draft 快速预览，final 定稿（默认）")
+    parser.add_argument("--resume", action="store_true", help="从输出目录中断处继续：复用 Step2.jsonl/match_results.json，校验已生成片段，只补齐缺失部分")
+    parser.add_argument("--full_render", action="store_true", help="忽略上次的渲染清单，重新生成全部片段")
+    parser.add_argument("--stream_step2", action="store_true", help="流式接收 Step2 输出，条目到达即开始合成")
+    parser.add_argument("--tts_endpoints", type=str, default=None,
+                        help="TTS 服务节点，逗号分隔（默认取 AUDIOBOOK_TTS_ENDPOINTS / AUDIOBOOK_ENDPOINTS 环境变量或本机）")
+    parser.add_argument("--audio_endpoints", type=str, default=None, help="MMAudio 服务节点，逗号分隔")
+    parser.add_argument("--rag_endpoints", type=str, default=None, help="RAG 服务节点，逗号分隔")
+    parser.add_argument("--no_llm_cache", action="store_true", help="跳过 LLM 响应缓存，强制重新请求（结果仍会写回缓存）")
     args = parser.parse_args()
 
+    LLM_CACHE_ENABLED = not args.no_llm_cache
+
+    def split_endpoints(value):
+        return [url.strip() for url in value.split(',') if url.strip()] if value else None
+
+    configure_endpoints(
+        tts=split_endpoints(args.tts_endpoints),
+        audio=split_endpoints(args.audio_endpoints),
+        rag=split_endpoints(args.rag_endpoints),
+    )
+
     # 创建输出目录
     os.makedirs(args.output_path, exist_ok=True)
 
+    # 断点续跑：脚本与说话人匹配沿用上次结果，只补齐缺失的片段
+    if args.resume:
+        json5l_path = os.path.join(args.output_path, "Step2.jsonl")
+        char_map_path = os.path.join(args.output_path, "match_results.json")
+        if not (os.path.exists(json5l_path) and os.path.exists(char_map_path)):
+            print(f"🛑 无法续跑：{args.output_path} 中缺少 Step2.jsonl 或 match_results.json。")
+            exit(1)
+        print(f"✅ 从 {args.output_path} 继续上次运行")
+        generate_and_run_audio_script(
+            script_path=json5l_path,
+            char_map_path=char_map_path,
+            output_dir=args.output_path,
+            result_filename="final_mix",
+            tts_concurrency=args.tts_concurrency,
+            audio_concurrency=args.audio_concurrency,
+            resume=True,
+            quality=args.quality,
+        )
+        exit(0)
+
     # Step 1: 生成嘉宾信息（原始 GPT 响应）
     if args.step1:
         print(f"✅ 【Step1】加载对话脚本")
@@ -292,6 +482,19 @@ if __name__ == "__main__":
         if step1_json_response is None:
             print("🛑 无法生成 Step2，因为没有 Step1 响应或 --text 参数。")
             exit(1)
+
+        if args.stream_step2:
+            script_dir = os.path.dirname(os.path.realpath(__file__))
+            generate_Step2_streaming(
+                step1_json_response,
+                args.output_path,
+                doc_file_path=os.path.join(script_dir, 'char_to_voice_map.json'),
+                tts_concurrency=args.tts_concurrency,
+                audio_concurrency=args.audio_concurrency,
+                incremental=not args.full_render,
+                quality=args.quality,
+            )
+            exit(0)
         
         step2_json_response = generate_Step2(step1_json_response, args.output_path)
         
@@ -325,5 +528,9 @@ if __name__ == "__main__":
         script_path=json5l_path,
         char_map_path=char_map_path,
         output_dir=args.output_path,
-        result_filename="final_mix"
+        result_filename="final_mix",
+        tts_concurrency=args.tts_concurrency,
+        audio_concurrency=args.audio_concurrency,
+        incremental=not args.full_render,
+        quality=args.quality,
     )
\ No newline at end of file
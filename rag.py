@@ -22,6 +22,17 @@ def load_embedding_model(model_name: str):
     model = AutoModel.from_pretrained(model_name)
     return tokenizer, model
 
+def parse_query_items(lines):
+    """从 JSONL 文本行中取出带 speaker 字段的查询条目。"""
+    query_items = []
+    for line in lines:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if 'speaker' in item:
+            query_items.append(item)
+    return query_items
+
 def rag_speakers(
     query_jsonl_path: str,
     doc_json_path: str,
@@ -30,22 +41,28 @@ def rag_speakers(
     model,
     max_length: int = 8192,
 ):
-    task = "你需要根据提供的名字，从文档中找出对这个名字描述最符合的段落"
-
-    query_items = []
     with open(query_jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            item = json.loads(line)
-            if 'speaker' in item:
-                query_items.append(item)
-
-    queries = [get_detailed_instruct(task, item['speaker']) for item in query_items]
-    speakers = [item['speaker'] for item in query_items]
+        query_items = parse_query_items(f)
 
     # 读取 documents
     with open(doc_json_path, 'r', encoding='utf-8') as f:
         doc_data = json.load(f)
 
+    final_result = match_speakers(query_items, doc_data, tokenizer, model, max_length=max_length)
+
+    with open(output_json_path, 'w', encoding='utf-8') as f_out:
+        json.dump(final_result, f_out, ensure_ascii=False, indent=2)
+
+    return final_result
+    # print(f"匹配结果已保存到 {output_json_path}")
+
+def match_speakers(query_items, doc_data, tokenizer, model, max_length: int = 8192):
+    """对已解析的查询条目与声音文档做匹配，返回 {说话人: 匹配信息}，不读写文件。"""
+    task = "你需要根据提供的名字，从文档中找出对这个名字描述最符合的段落"
+
+    queries = [get_detailed_instruct(task, item['speaker']) for item in query_items]
+    speakers = [item['speaker'] for item in query_items]
+
     doc_names = []
     documents = []
     for name, info in doc_data.items():
@@ -116,14 +133,10 @@ def rag_speakers(
             result_item[speaker_name] = speaker_name
             final_result[speaker_name] = result_item
 
-    with open(output_json_path, 'w', encoding='utf-8') as f_out:
-        json.dump(final_result, f_out, ensure_ascii=False, indent=2)
-
     return final_result
-    # print(f"匹配结果已保存到 {output_json_path}")
 
-tokenizer, model = load_embedding_model('/cpfs01/user/renyiming/.cache/modelscope/hub/models/Qwen/Qwen3-Embedding-0___6B')
 if __name__ == "__main__":
+    tokenizer, model = load_embedding_model('/cpfs01/user/renyiming/.cache/modelscope/hub/models/Qwen/Qwen3-Embedding-0___6B')
 # 使用示例
     rag_speakers(
         '/cpfs01/user/renyiming/AudiobookAgent/test.jsonl',
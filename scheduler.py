@@ -0,0 +1,297 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from api import tts, audio, register_speaker, ApiError
+from utils import MIX, CAT, COMPUTE_LEN
+from mixer import LoopSource
+from timeline import Timeline
+from code_generation import normalize_audio_type, new_wav_counters, make_wav_name, resolve_voice
+from manifest import clip_content_hash
+
+BG_SEED_LEN = 30  # 背景音种子片段时长（秒），LoopSource 再循环到实际区间长度
+
+
+class RenderScheduler:
+    """
+    进程内的并发渲染调度器，替代 exec() 生成的 generated_mix_code.py。
+
+    依赖关系：片段生成 -> 时长测量 -> CAT / 背景音床 (LoopSource) -> MIX。
+    TTS 与 MMAudio 各自使用独立的线程池（并发上限分别可配），
+    时长测量与混音在 CPU 线程池上执行，任务在依赖完成后由回调触发，不占用等待线程。
+    """
+
+    def __init__(self, wav_path, char_to_voice_map, tts_concurrency=1, audio_concurrency=1, cpu_workers=2,
+                 manifest=None, quality=None):
+        self.wav_path = str(wav_path)
+        os.makedirs(self.wav_path, exist_ok=True)
+        self.char_to_voice_map = char_to_voice_map
+        self.quality = quality  # MMAudio 质量档位，None 为服务端默认
+        self.wav_counters = new_wav_counters()
+
+        # 增量渲染：内容哈希命中上次清单的片段直接复用，只生成改动/新增的条目
+        self.manifest = manifest
+        self.reused = 0
+        self._used_keys = set()
+        if self.manifest is not None:
+            self.manifest.stage(self.wav_path)
+
+        self._tts_pool = ThreadPoolExecutor(max_workers=tts_concurrency, thread_name_prefix='tts')
+        self._audio_pool = ThreadPoolExecutor(max_workers=audio_concurrency, thread_name_prefix='mmaudio')
+        self._cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='mix')
+
+        self._fg_clips = []  # [{'wav': 路径, 'len': Future[秒]}]
+        self._bg_clips = []  # [{'wav': 路径, 'gen': Future, 'begin_id': int, 'end_id': int}]
+        self._failures = []
+        self._lock = threading.Lock()
+
+    # --- 依赖图工具 ---
+    def _when_all(self, deps, fn, pool):
+        """所有 deps 完成后把 fn(*results) 提交到 pool，返回代表其结果的 Future。"""
+        result = Future()
+        deps = list(deps)
+        remaining = [len(deps)]
+        lock = threading.Lock()
+
+        def launch():
+            for dep in deps:
+                if dep.exception() is not None:
+                    result.set_exception(dep.exception())
+                    return
+            pool.submit(fn, *[dep.result() for dep in deps]).add_done_callback(
+                lambda inner: self._forward(inner, result))
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                launch()
+
+        if not deps:
+            launch()
+        for dep in deps:
+            dep.add_done_callback(on_done)
+        return result
+
+    @staticmethod
+    def _forward(inner, result):
+        """把已完成的 inner 的结果或异常转交给 result。"""
+        if inner.exception() is not None:
+            result.set_exception(inner.exception())
+        else:
+            result.set_result(inner.result())
+
+    def _track(self, future, wav_file):
+        def on_done(f):
+            if f.exception() is not None:
+                with self._lock:
+                    self._failures.append((wav_file, f.exception()))
+                print(f"🛑 片段生成失败: {wav_file} - {f.exception()}")
+        future.add_done_callback(on_done)
+        return future
+
+    @staticmethod
+    def _resolved(value):
+        future = Future()
+        future.set_result(value)
+        return future
+
+    def _reuse(self, key, wav_file):
+        """命中清单时把旧片段复制到本次的文件名，返回记录的时长；未命中返回 None。"""
+        if self.manifest is None:
+            return None
+        self._used_keys.add(key)
+        if self.manifest.lookup(key, self.wav_path) is None:
+            return None
+        with self._lock:
+            self.reused += 1
+        return self.manifest.adopt(key, self.wav_path, wav_file)
+
+    def _measure(self, key):
+        def run(wav_file):
+            length = COMPUTE_LEN(wav_file)
+            if self.manifest is not None:
+                self.manifest.record(key, self.wav_path, wav_file, length)
+            return length
+        return run
+
+    # --- 片段生成 ---
+    def _run_tts(self, fg_audio, wav_file):
+        prompt_text, ref_full_path = resolve_voice(self.char_to_voice_map, fg_audio["character"])
+        # 音色在服务端注册一次后按 speaker_id 合成；注册失败时退回上传提示音频
+        try:
+            speaker_id = register_speaker(prompt_text, ref_full_path)
+        except ApiError as e:
+            print(f"⚠️ 说话人注册失败，改为上传提示音频: {e}")
+            speaker_id = None
+        # 失败时 tts() / audio() 抛出 ApiError，由 _track 记录
+        tts(tts_text=fg_audio["text"], prompt_text=prompt_text, prompt_speech_path=ref_full_path,
+            speaker=fg_audio["character"], volume=fg_audio["vol"], output_path=wav_file, speaker_id=speaker_id)
+        return wav_file
+
+    def _run_audio(self, desc, duration, volume, wav_file):
+        audio(prompt=desc, duration=duration, volume=volume, negative_prompt=" ", output_path=wav_file,
+              quality=self.quality)
+        return wav_file
+
+    def add_foreground(self, fg_audio, after=None):
+        """
+        提交一个前景片段（speech/sound_effect/music），按出现顺序拼接。
+
+        after 为可选的 Future（如流式渲染中新说话人的 RAG 匹配）：它完成后才计算内容哈希并提交生成，
+        失败时该片段记为失败。
+        """
+        wav_file = os.path.join(self.wav_path, make_wav_name(fg_audio, self.wav_counters))
+        audio_type = normalize_audio_type(fg_audio['audio_type'])
+        if audio_type not in ['speech', 'sound_effect', 'music']:
+            raise ValueError(f"Unsupported foreground audio_type: {audio_type}")
+
+        if after is None:
+            length = self._submit_foreground(fg_audio, audio_type, wav_file)
+        else:
+            length = Future()
+
+            def start(f):
+                try:
+                    f.result()
+                    self._submit_foreground(fg_audio, audio_type, wav_file).add_done_callback(
+                        lambda inner: self._forward(inner, length))
+                except Exception as e:
+                    with self._lock:
+                        self._failures.append((wav_file, e))
+                    print(f"🛑 片段生成失败: {wav_file} - {e}")
+                    length.set_exception(e)
+            after.add_done_callback(start)
+        self._fg_clips.append({'wav': wav_file, 'len': length})
+        return length
+
+    def _submit_foreground(self, fg_audio, audio_type, wav_file):
+        key = clip_content_hash(fg_audio, self.char_to_voice_map, quality=self.quality) if self.manifest is not None else None
+        reused_len = self._reuse(key, wav_file)
+        if reused_len is not None:
+            return self._resolved(reused_len)
+
+        if audio_type == 'speech':
+            gen = self._tts_pool.submit(self._run_tts, fg_audio, wav_file)
+        else:
+            gen = self._audio_pool.submit(self._run_audio, fg_audio["desc"], fg_audio["len"], fg_audio["vol"], wav_file)
+        self._track(gen, wav_file)
+        return self._when_all([gen], self._measure(key), self._cpu_pool)
+
+    def start_background(self, bg_audio):
+        """
+        在背景音 start 时即提交种子片段生成（只依赖 desc/vol），
+        区间由 stop_background 补全。返回该背景片段的句柄。
+        """
+        audio_type = normalize_audio_type(bg_audio['audio_type'])
+        if audio_type not in ['sound_effect', 'music']:
+            raise ValueError(f"Unsupported background audio_type: {audio_type}")
+
+        wav_file = os.path.join(self.wav_path, make_wav_name(bg_audio, self.wav_counters))
+        key = (clip_content_hash(bg_audio, self.char_to_voice_map, seed_len=BG_SEED_LEN, quality=self.quality)
+               if self.manifest is not None else None)
+        if self._reuse(key, wav_file) is not None:
+            gen = self._resolved(wav_file)
+        else:
+            gen = self._audio_pool.submit(self._run_audio, bg_audio["desc"], BG_SEED_LEN, bg_audio["vol"], wav_file)
+            self._track(gen, wav_file)
+            if self.manifest is not None:
+                def record(f):
+                    if f.exception() is None:
+                        self.manifest.record(key, self.wav_path, wav_file, BG_SEED_LEN)
+                gen.add_done_callback(record)
+        clip = {
+            'wav': wav_file,
+            'gen': gen,
+            'begin_id': bg_audio['begin_fg_audio_id'],
+            'end_id': None,
+        }
+        self._bg_clips.append(clip)
+        return clip
+
+    def stop_background(self, clip, end_fg_audio_id):
+        clip['end_id'] = end_fg_audio_id
+
+    def add_background(self, bg_audio):
+        """提交一个背景片段；需已带有 begin_fg_audio_id / end_fg_audio_id。"""
+        clip = self.start_background(bg_audio)
+        self.stop_background(clip, bg_audio['end_fg_audio_id'])
+        return clip
+
+    # --- 拼接与混音 ---
+    def finish(self, result_filename="final_mix"):
+        """构建 CAT/背景音床/MIX 依赖并等待最终混音完成，返回输出路径。"""
+        unclosed = [clip['wav'] for clip in self._bg_clips if clip['end_id'] is None]
+        if unclosed:
+            self.shutdown()
+            raise ValueError(f"end of background missing: {unclosed}")
+
+        fg_wavs = [clip['wav'] for clip in self._fg_clips]
+        fg_lens = [clip['len'] for clip in self._fg_clips]
+        foreground_wav = os.path.join(self.wav_path, "foreground.wav")
+        result_wav = os.path.join(self.wav_path, f"{result_filename}.wav")
+
+        cat = self._when_all(fg_lens, lambda *_: CAT(wavs=fg_wavs, out_wav=foreground_wav), self._cpu_pool)
+        # 前景时长到齐后建立整数采样点时间轴，背景区间的起点与长度直接查前缀和
+        spans = [(clip['begin_id'], clip['end_id']) for clip in self._bg_clips]
+        timeline = self._when_all(fg_lens, lambda *_: Timeline.from_wavs(fg_wavs, spans), self._cpu_pool)
+
+        def loop(index, wav_file):
+            # 背景音床在混音时按块生成，种子片段保持不变，以便下次增量渲染复用
+            def run(_, timeline):
+                bg_start, bg_length = timeline.span(*timeline.bg_spans[index])
+                return LoopSource(wav_file, bg_length, sr=timeline.sr), bg_start
+            return run
+
+        loops = [
+            self._when_all([clip['gen'], timeline], loop(index, clip['wav']), self._cpu_pool)
+            for index, clip in enumerate(self._bg_clips)
+        ]
+
+        def mix(_, *bg_pairs):
+            pairs = list(bg_pairs)
+            pairs.append((foreground_wav, 0))
+            MIX(wavs=pairs, out_wav=result_wav, samples=True)
+            return result_wav
+
+        final = self._when_all([cat] + loops, mix, self._cpu_pool)
+        try:
+            # 等待所有生成任务结束，以便一次性报告全部失败片段
+            for clip in self._fg_clips:
+                try:
+                    clip['len'].result()
+                except Exception:
+                    pass
+            for clip in self._bg_clips:
+                try:
+                    clip['gen'].result()
+                except Exception:
+                    pass
+            if self.manifest is not None:
+                self.manifest.finalize(self.wav_path, self._used_keys)
+            if self._failures:
+                failed = ", ".join(os.path.basename(wav_file) for wav_file, _ in self._failures)
+                raise RuntimeError(f"{len(self._failures)} 个片段生成失败: {failed}")
+            return final.result()
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for pool in (self._tts_pool, self._audio_pool, self._cpu_pool):
+            pool.shutdown(wait=True)
+
+    def run(self, fg_audios, bg_audios, result_filename="final_mix"):
+        print("🚀 开始并发生成音频文件")
+        start_time = time.time()
+        for fg_audio in fg_audios:
+            self.add_foreground(fg_audio)
+        for bg_audio in bg_audios:
+            self.add_background(bg_audio)
+        if self.manifest is not None:
+            print(f"♻️ 复用 {self.reused} 个未改动片段")
+        result_wav = self.finish(result_filename)
+        end_time = time.time()
+        print(f"🎉 音频生成完成，耗时 {end_time - start_time:.2f} 秒")
+        return result_wav
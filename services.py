@@ -1,14 +1,25 @@
+import contextlib
 import os
+import queue
+import struct
 import tempfile
-from pathlib import Path
+import threading
+import time
 import logging
-from flask import Flask, request, send_file, jsonify, after_this_request
-from Audio import load_mmaudio_model, audio
-from model import load_cosyvoice_model, tts
-import werkzeug.utils
-from rag import rag_speakers, last_token_pool, get_detailed_instruct
+from flask import Flask, Request, Response, g, request, send_file, jsonify
+from Audio import load_mmaudio_model, render_audio_batch
+from model import load_cosyvoice_model, tts_waveform, tts_stream, SpeakerRegistry
+import zipfile
+from io import BytesIO
+from cache import DiskLRUCache, MemoryLRUCache, make_cache_key
+from workers import BatchingWorker, ModelWorker, QueueFullError
+from startup import ModelStartup
+from metrics import MetricsRegistry
+from rag import match_speakers, parse_query_items, last_token_pool, get_detailed_instruct
 # RAG imports
 import torch
+import torchaudio
+import numpy as np
 import torch.nn.functional as F
 import json5 as json
 from torch import Tensor
@@ -18,7 +29,18 @@ from modelscope import AutoTokenizer, AutoModel
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# --- Request Uploads ---
+# 上传文件默认留在内存中，只有超过阈值的才落盘；落盘用的是匿名临时文件，进程崩溃也不会留下孤儿文件
+UPLOAD_SPOOL_MAX_BYTES = 16 * 2**20
+
+
+class SpooledRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES, mode='rb+')
+
+
 app = Flask(__name__)
+app.request_class = SpooledRequest
 
 # --- Model Loading ---
 MODEL_VARIANT = 'large_44k_v2'
@@ -29,6 +51,178 @@ MODELS = {
     "rag": None,
 }
 
+# --- Result Caches ---
+# TTS 片段按 (文本, 提示文本, 提示音频内容, 语速, 响度参数, 模型版本) 做内容寻址，跨运行共享
+TTS_MODEL_VERSION = 'CosyVoice2-0.5B'
+TTS_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'tts')
+TTS_CACHE_MAX_BYTES = 20 * 2**30
+TTS_CACHE = DiskLRUCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES, suffix='.wav')
+# 说话人注册表：音色特征按 speaker_id 缓存在内存 (LRU) 并持久化为 npz
+SPEAKER_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'speakers')
+MAX_CACHED_SPEAKERS = 64
+SPEAKERS = None
+# MMAudio 对固定参数（含 seed）是确定性的，直接缓存归一化后的波形
+# 条目为 {waveform, sample_rate, quality, params}；缓存键不含质量档位，final 结果会覆盖同键的 draft 结果
+AUDIO_CACHE_MAX_BYTES = 4 * 2**30
+AUDIO_CACHE = MemoryLRUCache(AUDIO_CACHE_MAX_BYTES, sizeof=lambda entry: entry['waveform'].nbytes)
+
+# --- MMAudio Quality Profiles ---
+# 按质量从低到高排列：draft 用于快速预览时间轴，final 用于定稿渲染
+QUALITY_PROFILES = {
+    "draft": {"num_steps": 16},
+    "final": {"num_steps": 100},
+}
+DEFAULT_QUALITY = "final"
+CUSTOM_QUALITY = "custom"  # 请求显式指定了 num_steps
+
+
+# --- Metrics ---
+# /metrics 以 Prometheus 文本格式导出；延迟拆分为排队时间与推理时间，便于区分“慢”与“堵”
+METRICS = MetricsRegistry(prefix='audiobook_')
+REQUESTS = METRICS.counter('requests_total', 'HTTP requests by route, method and status.', ('route', 'method', 'status'))
+REQUEST_SECONDS = METRICS.histogram('request_seconds', 'Time until the response headers are sent.', ('route',))
+QUEUE_SECONDS = METRICS.histogram('queue_seconds', 'Time a job waited in its model queue.', ('model',))
+INFERENCE_SECONDS = METRICS.histogram('inference_seconds', 'Compute time per model batch.', ('model',))
+BATCH_SIZE = METRICS.histogram('batch_size', 'Jobs per model batch.', ('model',), buckets=(1, 2, 4, 8, 16, 32))
+REALTIME_FACTOR = METRICS.histogram(
+    'realtime_factor', 'Seconds of audio generated per second of compute.', ('model',),
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128),
+)
+INPUT_TEXT_CHARS = METRICS.histogram(
+    'input_text_chars', 'Length of the TTS text or audio prompt in characters.', ('model',),
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200),
+)
+GENERATED_AUDIO_SECONDS = METRICS.histogram(
+    'generated_audio_seconds', 'Duration of each generated clip.', ('model',),
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300),
+)
+GPU_PEAK_MEMORY = METRICS.gauge(
+    'gpu_peak_memory_bytes',
+    "Peak GPU memory allocated during the model's batches; includes resident weights and overlapping batches "
+    "of other models.",
+    ('model',),
+)
+
+
+def cache_stat(field):
+    caches = (("tts", TTS_CACHE), ("audio", AUDIO_CACHE))
+    return lambda: [({"cache": name}, cache.stats()[field]) for name, cache in caches]
+
+
+METRICS.callback('cache_hits_total', 'Result cache hits.', 'counter', cache_stat('hits'))
+METRICS.callback('cache_misses_total', 'Result cache misses.', 'counter', cache_stat('misses'))
+METRICS.callback('cache_hit_ratio', 'Result cache hit rate since start.', 'gauge', cache_stat('hit_rate'))
+METRICS.callback('cache_evictions_total', 'Result cache evictions.', 'counter', cache_stat('evictions'))
+METRICS.callback('cache_bytes', 'Bytes held by the result cache.', 'gauge', cache_stat('bytes'))
+METRICS.callback(
+    'queue_depth', 'Jobs waiting per model queue.', 'gauge',
+    lambda: [({"model": worker.name}, worker.depth) for worker in (AUDIO_BATCHER, TTS_WORKER, RAG_WORKER)],
+)
+
+
+def observe_batch(model, queue_times, compute_time):
+    for queue_time in queue_times:
+        QUEUE_SECONDS.observe(queue_time, model=model)
+    INFERENCE_SECONDS.observe(compute_time, model=model)
+    BATCH_SIZE.observe(len(queue_times), model=model)
+
+
+# The CUDA allocator keeps a single process-wide peak, so each batch runs in a section: the peak is reset
+# when a section starts with no other section running, and read when it ends. Batches that overlap share
+# one window and each records the peak of the whole window.
+_gpu_sections = {'active': 0}
+_gpu_sections_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def gpu_peak_section(model):
+    if not torch.cuda.is_available():
+        yield
+        return
+    with _gpu_sections_lock:
+        if _gpu_sections['active'] == 0:
+            torch.cuda.reset_peak_memory_stats()
+        _gpu_sections['active'] += 1
+    try:
+        yield
+    finally:
+        with _gpu_sections_lock:
+            GPU_PEAK_MEMORY.set_max(torch.cuda.max_memory_allocated(), model=model)
+            _gpu_sections['active'] -= 1
+
+
+def observe_synthesis(model, texts, audio_seconds, compute_seconds):
+    """Record input lengths, clip durations and the real-time factor of one generation call."""
+    for text in texts:
+        INPUT_TEXT_CHARS.observe(len(text), model=model)
+    for seconds in audio_seconds:
+        GENERATED_AUDIO_SECONDS.observe(seconds, model=model)
+    if compute_seconds > 0:
+        REALTIME_FACTOR.observe(sum(audio_seconds) / compute_seconds, model=model)
+
+
+def run_audio_batch(items):
+    started_at = time.monotonic()
+    results = render_audio_batch(items, MODELS["mmaudio"])
+    observe_synthesis(
+        'mmaudio', [item['prompt'] for item in items],
+        [waveform.shape[-1] / sample_rate for waveform, sample_rate in results],
+        time.monotonic() - started_at,
+    )
+    return results
+
+
+# --- Per-Model Work Queues ---
+# Flask 的请求线程只做解析、查缓存和编码；模型推理统一交给每个模型独占的 worker 线程。
+# 队列有界：排满时直接返回 429 + Retry-After，而不是让请求堆积到客户端超时。
+# 并发的 /audio 请求在 AUDIO_MAX_BATCH_WAIT 秒内收集，按 (duration, num_steps, cfg_strength) 分组后一次采样
+AUDIO_MAX_BATCH_SIZE = 8
+AUDIO_MAX_BATCH_WAIT = 0.05
+AUDIO_MAX_QUEUE = 32
+TTS_MAX_QUEUE = 64
+RAG_MAX_QUEUE = 8
+AUDIO_BATCHER = BatchingWorker(
+    'mmaudio',
+    run_batch=run_audio_batch,
+    group_key=lambda item: (item['duration'], item['num_steps'], item['cfg_strength']),
+    max_batch_size=AUDIO_MAX_BATCH_SIZE,
+    max_wait=AUDIO_MAX_BATCH_WAIT,
+    max_queue_size=AUDIO_MAX_QUEUE,
+    on_batch=observe_batch,
+    batch_context=gpu_peak_section,
+)
+TTS_WORKER = ModelWorker('cosyvoice', max_queue_size=TTS_MAX_QUEUE, on_batch=observe_batch,
+                         batch_context=gpu_peak_section)
+RAG_WORKER = ModelWorker('rag', max_queue_size=RAG_MAX_QUEUE, on_batch=observe_batch,
+                         batch_context=gpu_peak_section)
+
+
+def queue_full_response(e):
+    """429 response for a rejected submission; Retry-After is the worker's own estimate."""
+    log.warning(str(e))
+    response = jsonify({"error": str(e), "retry_after": e.retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def with_timing(response, *jobs):
+    """
+    Report how long the request waited in model queues vs. how long inference took.
+    Cache hits have no job and report zero for both.
+    """
+    jobs = [job for job in jobs if job is not None]
+    response.headers['X-Queue-Time'] = f"{sum(job.queue_time for job in jobs):.3f}"
+    response.headers['X-Compute-Time'] = f"{sum(job.compute_time for job in jobs):.3f}"
+    return response
+
+
+def encode_wav(waveform, sample_rate):
+    """Encode a (channels, samples) float tensor as an in-memory WAV file."""
+    buffer = BytesIO()
+    torchaudio.save(buffer, waveform, sample_rate, format='wav')
+    buffer.seek(0)
+    return buffer
 
 
 def load_rag_model(model_name: str = '/cpfs01/user/renyiming/.cache/modelscope/hub/models/Qwen/Qwen3-Embedding-0___6B'):
@@ -43,30 +237,121 @@ def load_rag_model(model_name: str = '/cpfs01/user/renyiming/.cache/modelscope/h
         log.error(f"Error loading RAG model: {e}", exc_info=True)
         raise
 
-def load_models():
-    """Load all models in a consolidated way."""
-    
-    # Configuration for all models to be loaded
-    model_loaders = {
+# --- Startup ---
+# 三个模型互不依赖，并行加载；每个模型加载并预热完成后立即开始服务，不必等其余模型
+# 预热：用极短的输入跑一次推理，让 CUDA kernel 选择、TRT/vLLM 引擎初始化发生在启动阶段而不是第一个请求上
+WARMUP_ENABLED = {"mmaudio": True, "cosyvoice": True, "rag": True}
+WARMUP_AUDIO_DURATION = 8.0  # 与 /audio 默认时长相同，预热对应的序列长度配置
+WARMUP_AUDIO_STEPS = 2
+WARMUP_TTS_TEXT = '你好。'
+
+
+def warmup_mmaudio(model_bundle):
+    render_audio_batch([{
+        'prompt': 'rain',
+        'negative_prompt': '',
+        'duration': WARMUP_AUDIO_DURATION,
+        'num_steps': WARMUP_AUDIO_STEPS,
+        'normalize': False,
+    }], model_bundle)
+
+
+def warmup_cosyvoice(model):
+    # Any prompt audio works for warming the kernels; use two seconds of a quiet tone
+    t = torch.arange(2 * 16000, dtype=torch.float32) / 16000
+    prompt_speech = encode_wav((0.1 * torch.sin(2 * torch.pi * 220 * t)).unsqueeze(0), 16000)
+    tts_waveform(model, WARMUP_TTS_TEXT, WARMUP_TTS_TEXT, prompt_speech, normalize=False)
+
+
+def warmup_rag(rag_model):
+    match_speakers(
+        [{'speaker': '旁白'}],
+        {'旁白': {'desc': '沉稳的男声'}},
+        tokenizer=rag_model['tokenizer'],
+        model=rag_model['model'],
+    )
+
+
+STARTUP = ModelStartup(
+    MODELS,
+    loaders={
         "mmaudio": lambda: load_mmaudio_model(variant=MODEL_VARIANT, full_precision=FULL_PRECISION),
         "cosyvoice": load_cosyvoice_model,
-        "rag": load_rag_model
-    }
-
+        "rag": load_rag_model,
+    },
+    warmups={
+        name: warmup for name, warmup in (
+            ("mmaudio", warmup_mmaudio), ("cosyvoice", warmup_cosyvoice), ("rag", warmup_rag)
+        ) if WARMUP_ENABLED[name]
+    },
+)
+
+
+def load_models(wait=True):
+    """Load all models concurrently; with wait=False the call returns while they load in the background."""
     log.info("Loading all models...")
-    for name, loader in model_loaders.items():
-        if MODELS[name] is None:
-            log.info(f"Loading {name} model...")
-            try:
-                MODELS[name] = loader()
-                log.info(f"{name.capitalize()} model loaded successfully.")
-            except Exception as e:
-                log.error(f"Error loading {name} model: {e}", exc_info=True)
-                # Continue to allow other models to load
+    STARTUP.start()
+    if wait:
+        STARTUP.wait()
 
 # --- Routes ---
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.monotonic()
+
+
+@app.after_request
+def record_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    REQUESTS.inc(route=route, method=request.method, status=str(response.status_code))
+    REQUEST_SECONDS.observe(time.monotonic() - g.request_started_at, route=route)
+    return response
+
+
+def quality_rank(quality):
+    return list(QUALITY_PROFILES).index(quality)
+
+
+def audio_cache_key(params, quality):
+    """Tiered results share one key so a final render replaces the draft; custom step counts are keyed apart."""
+    key_parts = [
+        params['prompt'], params['negative_prompt'], params['duration'], params['cfg_strength'], params['seed'],
+        params['normalize'], params['volume'], params['peak_norm_db_for_norm'], MODEL_VARIANT,
+    ]
+    if quality == CUSTOM_QUALITY:
+        key_parts.append(params['num_steps'])
+    return make_cache_key(*key_parts)
+
+
+def render_audio_entry(cache_key, params, quality):
+    """Queue one render on the MMAudio batcher and cache it; returns (entry, job)."""
+    job = AUDIO_BATCHER.submit(params)
+    waveform, sample_rate = job.result()
+    entry = {"waveform": waveform, "sample_rate": sample_rate, "quality": quality, "params": params}
+    AUDIO_CACHE.put(cache_key, entry)
+    return entry, job
+
+
+def audio_response(entry, cache_key, job):
+    response = with_timing(send_file(
+        encode_wav(entry['waveform'], entry['sample_rate']),
+        as_attachment=True,
+        download_name=f'generated_audio.wav',
+        mimetype='audio/wav'
+    ), job)
+    response.headers['X-Quality'] = entry['quality']
+    response.headers['X-Audio-Cache-Key'] = cache_key
+    return response
+
+
 @app.route('/audio', methods=['POST'])
 def generate_audio():
+    """
+    Generate a sound effect / music clip. 'quality' selects a profile from QUALITY_PROFILES
+    (default DEFAULT_QUALITY); an explicit 'num_steps' overrides the profile. A cached result of
+    the requested tier or better is served directly; a cached draft is re-rendered when final
+    is requested and replaced under the same cache key.
+    """
     if MODELS["mmaudio"] is None:
         return jsonify({"error": "MMAudio model is not loaded. Please try again later."}), 503
 
@@ -75,139 +360,467 @@ def generate_audio():
         if not data or 'prompt' not in data:
             return jsonify({"error": "'prompt' is a required field."}), 400
 
+        quality = data.get('quality', DEFAULT_QUALITY)
+        if 'num_steps' in data:
+            quality = CUSTOM_QUALITY
+        elif quality not in QUALITY_PROFILES:
+            return jsonify({"error": f"Unknown quality '{quality}', expected one of {list(QUALITY_PROFILES)}."}), 400
+
         # Extract parameters from request
         prompt = data.get('prompt')
-        negative_prompt = data.get('negative_prompt', '')
-        duration = float(data.get('duration', 8.0))
-        cfg_strength = float(data.get('cfg_strength', 4.5))
-        num_steps = int(data.get('num_steps', 100))
-        seed = int(data.get('seed', 42))
-        normalize = bool(data.get('normalize', True))
-        volume = float(data.get('volume', -23.0))
-        peak_norm_db = float(data.get('peak_norm_db_for_norm', -1.0))
-
-        # Generate audio to a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_file:
-            output_path = Path(tmp_file.name)
-
-        log.info(f"Generating audio for prompt: {prompt}")
-
-        generated_path = audio(
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            model_bundle=MODELS["mmaudio"],
-            duration=duration,
-            cfg_strength=cfg_strength,
-            num_steps=num_steps,
-            seed=seed,
-            output_path=output_path,
-            normalize=normalize,
-            volume=volume,
-            peak_norm_db_for_norm=peak_norm_db,
-        )
-
-        log.info(f"Audio generated at: {generated_path}")
-        
-        # Clean up temporary files after the request
-        @after_this_request
-        def cleanup(response):
-            try:
-                os.remove(generated_path)
-                log.info(f"Cleaned up temporary file: {generated_path}")
-            except OSError as e:
-                log.error(f"Error cleaning up file {generated_path}: {e}", exc_info=True)
-            return response
-
-        return send_file(
-            generated_path,
-            as_attachment=True,
-            download_name=f'generated_audio.wav',
-            mimetype='audio/wav'
-        )
-
+        params = {
+            'prompt': prompt,
+            'negative_prompt': data.get('negative_prompt', ''),
+            'duration': float(data.get('duration', 8.0)),
+            'cfg_strength': float(data.get('cfg_strength', 4.5)),
+            'num_steps': int(data['num_steps']) if quality == CUSTOM_QUALITY else QUALITY_PROFILES[quality]['num_steps'],
+            'seed': int(data.get('seed', 42)),
+            'normalize': bool(data.get('normalize', True)),
+            'volume': float(data.get('volume', -23.0)),
+            'peak_norm_db_for_norm': float(data.get('peak_norm_db_for_norm', -1.0)),
+        }
+
+        cache_key = audio_cache_key(params, quality)
+        entry = AUDIO_CACHE.get(cache_key)
+        job = None
+        if entry is not None and (quality == CUSTOM_QUALITY or quality_rank(entry['quality']) >= quality_rank(quality)):
+            log.info(f"Audio cache hit ({entry['quality']}) for prompt: {prompt}")
+        else:
+            log.info(f"Generating {quality} audio ({params['num_steps']} steps) for prompt: {prompt}")
+            entry, job = render_audio_entry(cache_key, params, quality)
+            log.info(f"Audio generated for prompt: {prompt}")
+
+        return audio_response(entry, cache_key, job)
+
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         log.error(f"An error occurred during audio generation: {e}", exc_info=True)
         return jsonify({"error": "Failed to generate audio.", "details": str(e)}), 500
 
 
-@app.route('/tts', methods=['POST'])
-def generate_tts():
-    if MODELS["cosyvoice"] is None:
-        return jsonify({"error": "CosyVoice model is not loaded. Please try again later."}), 503
+@app.route('/audio/promote', methods=['POST'])
+def promote_audio():
+    """
+    Re-render a cached draft at final quality under the same cache key. Takes JSON
+    {"cache_key": <X-Audio-Cache-Key of the draft response>} and returns the final WAV.
+    Evicted drafts give 404; re-send the original /audio request with quality=final instead.
+    """
+    if MODELS["mmaudio"] is None:
+        return jsonify({"error": "MMAudio model is not loaded. Please try again later."}), 503
 
     try:
-        # Check for required form fields
-        if 'tts_text' not in request.form or 'prompt_text' not in request.form:
-            return jsonify({"error": "'tts_text' and 'prompt_text' are required form fields."}), 400
-        
-        # Check for required file
-        if 'prompt_speech_file' not in request.files:
-            return jsonify({"error": "'prompt_speech_file' is a required file upload."}), 400
-
-        tts_text = request.form['tts_text']
-        prompt_text = request.form['prompt_text']
+        data = request.get_json()
+        if not data or 'cache_key' not in data:
+            return jsonify({"error": "'cache_key' is a required field."}), 400
+        cache_key = data['cache_key']
+        entry = AUDIO_CACHE.get(cache_key)
+        if entry is None:
+            return jsonify({"error": f"No cached audio for key '{cache_key}'."}), 404
+        if entry['quality'] == CUSTOM_QUALITY:
+            return jsonify({"error": "Audio rendered with a custom num_steps cannot be promoted."}), 400
+
+        job = None
+        if entry['quality'] != "final":
+            log.info(f"Promoting audio to final for prompt: {entry['params']['prompt']}")
+            params = {**entry['params'], 'num_steps': QUALITY_PROFILES["final"]['num_steps']}
+            entry, job = render_audio_entry(cache_key, params, "final")
+
+        return audio_response(entry, cache_key, job)
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        log.error(f"An error occurred during audio promotion: {e}", exc_info=True)
+        return jsonify({"error": "Failed to promote audio.", "details": str(e)}), 500
+
+
+def get_speaker_registry():
+    global SPEAKERS
+    if SPEAKERS is None:
+        SPEAKERS = SpeakerRegistry(MODELS["cosyvoice"], SPEAKER_CACHE_DIR, max_speakers=MAX_CACHED_SPEAKERS)
+    return SPEAKERS
+
+
+def make_speaker_id(prompt_text, prompt_speech_bytes):
+    """A voice is identified by its prompt text and prompt wav content."""
+    return make_cache_key(prompt_text, prompt_speech_bytes, TTS_MODEL_VERSION)[:32]
+
+
+def load_speaker(speaker_id, prompt_text='', prompt_speech_bytes=None, filename=None):
+    """
+    Make sure the prompt features of speaker_id are cached. Unknown voices are registered from
+    the uploaded prompt speech if one was given, otherwise KeyError is raised.
+    """
+    registry = get_speaker_registry()
+    if registry.ensure_loaded(speaker_id):
+        return registry.npz_path(speaker_id)
+    if prompt_speech_bytes is None:
+        raise KeyError(f"Unknown speaker_id '{speaker_id}'. Register it via /speakers first.")
+    return registry.register(speaker_id, prompt_text, BytesIO(prompt_speech_bytes))
+
+
+def tts_cache_key(tts_text, speaker_id, speed, normalize, volume, peak_norm_db):
+    return make_cache_key(
+        tts_text, speaker_id, speed, normalize, volume, peak_norm_db, TTS_MODEL_VERSION
+    )
+
+
+def render_tts(tts_text, speaker_id, prompt_text='', prompt_speech_bytes=None, filename=None,
+               speed=1.0, normalize=True, volume=-23.0, peak_norm_db=-1.0):
+    """
+    Run CosyVoice for one line and store the result in the clip cache. Must run on TTS_WORKER.
+
+    The voice's CosyVoice prompt features come from the speaker registry, so each prompt wav is
+    only processed the first time it is seen.
+    """
+    load_speaker(speaker_id, prompt_text, prompt_speech_bytes, filename)
+
+    log.info(f"Generating TTS for text: {tts_text[:50]}...")
+    started_at = time.monotonic()
+    waveform = tts_waveform(
+        model=MODELS["cosyvoice"],
+        tts_text=tts_text,
+        prompt_text='',
+        prompt_speech_16k='',
+        speed=speed,
+        normalize=normalize,
+        volume=volume,
+        peak_norm_db_for_norm=peak_norm_db,
+        zero_shot_spk_id=speaker_id,
+    )
+    if waveform is None:
+        raise RuntimeError("CosyVoice produced no audio.")
+    sample_rate = MODELS["cosyvoice"].sample_rate
+    observe_synthesis('cosyvoice', [tts_text], [waveform.shape[-1] / sample_rate], time.monotonic() - started_at)
+    wav_bytes = encode_wav(waveform, sample_rate).getvalue()
+
+    TTS_CACHE.put(tts_cache_key(tts_text, speaker_id, speed, normalize, volume, peak_norm_db), wav_bytes)
+    return wav_bytes
+
+
+def synthesize_tts(tts_text, speaker_id, prompt_text='', prompt_speech_bytes=None, filename=None,
+                   speed=1.0, normalize=True, volume=-23.0, peak_norm_db=-1.0):
+    """
+    Serve one line from the clip cache or queue it on the CosyVoice worker.
+    Returns (wav_bytes, job); job is None for cache hits.
+    """
+    cached_wav = TTS_CACHE.get(tts_cache_key(tts_text, speaker_id, speed, normalize, volume, peak_norm_db))
+    if cached_wav is not None:
+        log.info(f"TTS cache hit for text: {tts_text[:50]}...")
+        return cached_wav, None
+
+    job = TTS_WORKER.submit(
+        render_tts, tts_text, speaker_id, prompt_text, prompt_speech_bytes, filename,
+        speed=speed, normalize=normalize, volume=volume, peak_norm_db=peak_norm_db,
+    )
+    return job.result(), job
+
+
+def parse_tts_form():
+    """
+    Read the /tts form fields. A registered speaker_id replaces both prompt_text and the prompt
+    speech upload. Raises ValueError with a message for the client on invalid input.
+    """
+    speaker_id = request.form.get('speaker_id')
+    if 'tts_text' not in request.form or (not speaker_id and 'prompt_text' not in request.form):
+        raise ValueError("'tts_text' and 'prompt_text' (or 'speaker_id') are required form fields.")
+
+    # Check for required file
+    if not speaker_id and 'prompt_speech_file' not in request.files:
+        raise ValueError("'prompt_speech_file' is a required file upload.")
+
+    prompt_text = request.form.get('prompt_text', '')
+    prompt_speech_bytes = filename = None
+    if not speaker_id:
         prompt_speech_file = request.files['prompt_speech_file']
-        
+        prompt_speech_bytes = prompt_speech_file.read()
+        filename = prompt_speech_file.filename
+        speaker_id = make_speaker_id(prompt_text, prompt_speech_bytes)
+
+    return dict(
+        tts_text=request.form['tts_text'],
+        speaker_id=speaker_id,
+        prompt_text=prompt_text,
+        prompt_speech_bytes=prompt_speech_bytes,
+        filename=filename,
         # Optional parameters
-        speed = float(request.form.get('speed', 1.0))
-        normalize = request.form.get('normalize', 'true').lower() == 'true'
-        volume = float(request.form.get('volume', -23.0))
-        peak_norm_db = float(request.form.get('peak_norm_db_for_norm', -1.0))
-
-        # Save the uploaded prompt speech to a temporary file
-        prompt_filename = werkzeug.utils.secure_filename(prompt_speech_file.filename)
-        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(prompt_filename)[1], delete=False) as tmp_prompt_file:
-            prompt_speech_file.save(tmp_prompt_file.name)
-            prompt_speech_path = tmp_prompt_file.name
-
-        # Prepare output path in a temporary file
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_output_file:
-            output_path = Path(tmp_output_file.name)
-
-        log.info(f"Generating TTS for text: {tts_text[:50]}...")
-
-        tts(
-            model=MODELS["cosyvoice"],
-            tts_text=tts_text,
-            prompt_text=prompt_text,
-            prompt_speech_16k=prompt_speech_path,
-            out_wav=str(output_path),
-            speed=speed,
-            normalize=normalize,
-            volume=volume,
-            peak_norm_db_for_norm=peak_norm_db
-        )
+        speed=float(request.form.get('speed', 1.0)),
+        normalize=request.form.get('normalize', 'true').lower() == 'true',
+        volume=float(request.form.get('volume', -23.0)),
+        peak_norm_db=float(request.form.get('peak_norm_db_for_norm', -1.0)),
+    )
 
-        log.info(f"TTS audio generated at: {output_path}")
 
-        # Clean up temporary files after the request
-        @after_this_request
-        def cleanup_tts(response):
-            try:
-                os.remove(prompt_speech_path)
-                log.info(f"Cleaned up temporary prompt file: {prompt_speech_path}")
-                os.remove(output_path)
-                log.info(f"Cleaned up temporary output file: {output_path}")
-            except OSError as e:
-                log.error(f"Error cleaning up TTS files: {e}", exc_info=True)
-            return response
-
-        return send_file(
-            output_path,
+@app.route('/tts', methods=['POST'])
+def generate_tts():
+    if MODELS["cosyvoice"] is None:
+        return jsonify({"error": "CosyVoice model is not loaded. Please try again later."}), 503
+
+    try:
+        try:
+            tts_args = parse_tts_form()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        try:
+            wav_bytes, job = synthesize_tts(**tts_args)
+        except KeyError as e:
+            return jsonify({"error": str(e.args[0])}), 404
+
+        return with_timing(send_file(
+            BytesIO(wav_bytes),
             as_attachment=True,
             download_name='generated_tts.wav',
             mimetype='audio/wav'
-        )
+        ), job)
 
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         log.error(f"An error occurred during TTS generation: {e}", exc_info=True)
-        # Clean up temporary files if they exist on error
-        if 'prompt_speech_path' in locals() and os.path.exists(prompt_speech_path):
-            os.remove(prompt_speech_path)
-        if 'output_path' in locals() and os.path.exists(output_path):
-            os.remove(output_path)
         return jsonify({"error": "Failed to generate TTS audio.", "details": str(e)}), 500
 
+
+# Streamed WAVs are 16-bit mono PCM; the RIFF/data sizes are unknown until the last chunk
+STREAM_WAV_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def wav_header(sample_rate, num_samples=None):
+    """44-byte 16-bit mono PCM WAV header; without num_samples the sizes are left unknown."""
+    if num_samples is None:
+        riff_size = data_size = STREAM_WAV_UNKNOWN_SIZE
+    else:
+        data_size = num_samples * 2
+        riff_size = 36 + data_size
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI', b'RIFF', riff_size, b'WAVE', b'fmt ', 16, 1, 1,
+        sample_rate, sample_rate * 2, 2, 16, b'data', data_size
+    )
+
+
+def encode_pcm16(chunk):
+    return (np.clip(chunk, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+
+
+@app.route('/tts_stream', methods=['POST'])
+def generate_tts_stream():
+    """
+    Same form fields as /tts, but the WAV is sent with chunked transfer encoding while CosyVoice
+    is still generating, with loudness normalized incrementally. The header's RIFF/data sizes are
+    0xFFFFFFFF; clients patch them once the stream ends. The response starts after the first
+    audio chunk, so X-Queue-Time and X-First-Chunk-Time are known but the total compute time is not.
+    """
+    if MODELS["cosyvoice"] is None:
+        return jsonify({"error": "CosyVoice model is not loaded. Please try again later."}), 503
+
+    try:
+        try:
+            tts_args = parse_tts_form()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        speaker_id = tts_args['speaker_id']
+        params = {k: tts_args[k] for k in ('speed', 'normalize', 'volume', 'peak_norm_db')}
+        sample_rate = MODELS["cosyvoice"].sample_rate
+
+        # Streamed gain differs slightly from the whole-clip normalization of /tts, so cache separately
+        cache_key = make_cache_key('stream', tts_cache_key(tts_args['tts_text'], speaker_id, **params))
+        cached_wav = TTS_CACHE.get(cache_key)
+        if cached_wav is not None:
+            log.info(f"TTS stream cache hit for text: {tts_args['tts_text'][:50]}...")
+            return with_timing(Response(cached_wav, mimetype='audio/wav'))
+
+        # The worker thread hands over a start timestamp, then PCM chunks, then None when done
+        chunks = queue.Queue()
+        cancelled = threading.Event()
+
+        def stream_job():
+            chunks.put(time.monotonic())
+            load_speaker(speaker_id, tts_args['prompt_text'], tts_args['prompt_speech_bytes'], tts_args['filename'])
+            log.info(f"Streaming TTS for text: {tts_args['tts_text'][:50]}...")
+            stream_started_at = time.monotonic()
+            pcm = []
+            for chunk in tts_stream(
+                MODELS["cosyvoice"], tts_args['tts_text'], '', '',
+                speed=params['speed'], normalize=params['normalize'], volume=params['volume'],
+                peak_norm_db_for_norm=params['peak_norm_db'], zero_shot_spk_id=speaker_id,
+            ):
+                if cancelled.is_set():
+                    log.info("TTS stream cancelled by client.")
+                    return
+                data = encode_pcm16(chunk)
+                pcm.append(data)
+                chunks.put(data)
+            pcm = b''.join(pcm)
+            if not pcm:
+                raise RuntimeError("CosyVoice produced no audio.")
+            observe_synthesis('cosyvoice', [tts_args['tts_text']], [len(pcm) / 2 / sample_rate],
+                              time.monotonic() - stream_started_at)
+            TTS_CACHE.put(cache_key, wav_header(sample_rate, len(pcm) // 2) + pcm)
+
+        job = TTS_WORKER.submit(stream_job)
+        job.add_done_callback(lambda _: chunks.put(None))
+        started_at = chunks.get()
+        first = chunks.get()
+        if first is None:
+            try:
+                job.result()
+            except KeyError as e:
+                return jsonify({"error": str(e.args[0])}), 404
+        first_chunk_at = time.monotonic()
+
+        def generate():
+            try:
+                yield wav_header(sample_rate) + first
+                while True:
+                    data = chunks.get()
+                    if data is None:
+                        break
+                    yield data
+                # Raising here aborts the chunked response, so the client sees a broken stream
+                # instead of a silently truncated WAV
+                job.result()
+            finally:
+                cancelled.set()
+
+        response = Response(generate(), mimetype='audio/wav')
+        response.headers['X-Queue-Time'] = f"{started_at - job.enqueued_at:.3f}"
+        response.headers['X-First-Chunk-Time'] = f"{first_chunk_at - started_at:.3f}"
+        return response
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        log.error(f"An error occurred during streaming TTS generation: {e}", exc_info=True)
+        return jsonify({"error": "Failed to generate TTS audio.", "details": str(e)}), 500
+
+
+@app.route('/tts_batch', methods=['POST'])
+def generate_tts_batch():
+    """
+    Synthesize many lines in one request.
+
+    Form field 'lines' is a JSON list of {tts_text, prompt_text, prompt_ref, speed?, normalize?,
+    volume?, peak_norm_db_for_norm?}; every distinct prompt wav is uploaded once as a file whose
+    field name is its prompt_ref. A line may give a registered 'speaker_id' instead of
+    prompt_text/prompt_ref. The response is a zip archive with one '<index>.wav' per successful
+    line plus 'results.json' listing the file or error for each line.
+    """
+    if MODELS["cosyvoice"] is None:
+        return jsonify({"error": "CosyVoice model is not loaded. Please try again later."}), 503
+
+    try:
+        if 'lines' not in request.form:
+            return jsonify({"error": "'lines' is a required form field."}), 400
+        lines = json.loads(request.form['lines'])
+        missing_refs = {line.get('prompt_ref') for line in lines if not line.get('speaker_id')} - set(request.files)
+        if missing_refs:
+            return jsonify({"error": f"Missing prompt speech uploads: {sorted(map(str, missing_refs))}"}), 400
+
+        prompt_uploads = {
+            ref: (prompt_speech_file.read(), prompt_speech_file.filename)
+            for ref, prompt_speech_file in request.files.items()
+        }
+
+        log.info(f"Generating TTS batch of {len(lines)} lines with {len(prompt_uploads)} prompt voices")
+
+        # Cache hits are answered here; the misses go to the CosyVoice worker as a single job, so
+        # a batch is admitted (or rejected with 429) as a whole and its lines are not interleaved.
+        wav_results = {}
+        to_render = []
+        for index, line in enumerate(lines):
+            try:
+                speaker_id = line.get('speaker_id')
+                prompt_text = line.get('prompt_text', '')
+                prompt_speech_bytes = filename = None
+                if not speaker_id:
+                    prompt_speech_bytes, filename = prompt_uploads[line['prompt_ref']]
+                    speaker_id = make_speaker_id(prompt_text, prompt_speech_bytes)
+                params = dict(
+                    speed=float(line.get('speed', 1.0)),
+                    normalize=bool(line.get('normalize', True)),
+                    volume=float(line.get('volume', -23.0)),
+                    peak_norm_db=float(line.get('peak_norm_db_for_norm', -1.0)),
+                )
+            except Exception as e:
+                wav_results[index] = e
+                continue
+            cached_wav = TTS_CACHE.get(tts_cache_key(line['tts_text'], speaker_id, **params))
+            if cached_wav is not None:
+                wav_results[index] = cached_wav
+            else:
+                to_render.append((index, (line['tts_text'], speaker_id, prompt_text, prompt_speech_bytes, filename), params))
+
+        def render_lines():
+            rendered = {}
+            for index, args, params in to_render:
+                try:
+                    rendered[index] = render_tts(*args, **params)
+                except Exception as e:
+                    rendered[index] = e
+            return rendered
+
+        job = None
+        if to_render:
+            job = TTS_WORKER.submit(render_lines)
+            wav_results.update(job.result())
+
+        archive = BytesIO()
+        results = []
+        with zipfile.ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for index in range(len(lines)):
+                wav_bytes = wav_results[index]
+                if isinstance(wav_bytes, Exception):
+                    log.error(f"TTS batch line {index} failed: {wav_bytes}")
+                    results.append({"index": index, "error": str(wav_bytes)})
+                    continue
+                zf.writestr(f"{index:05d}.wav", wav_bytes)
+                results.append({"index": index, "file": f"{index:05d}.wav"})
+            zf.writestr("results.json", json.dumps(results, ensure_ascii=False, quote_keys=True))
+        archive.seek(0)
+
+        return with_timing(send_file(
+            archive,
+            as_attachment=True,
+            download_name='generated_tts_batch.zip',
+            mimetype='application/zip'
+        ), job)
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        log.error(f"An error occurred during batch TTS generation: {e}", exc_info=True)
+        return jsonify({"error": "Failed to generate TTS batch.", "details": str(e)}), 500
+
+
+@app.route('/speakers', methods=['POST'])
+def register_speaker():
+    """
+    Register a voice once: extract its CosyVoice prompt features and return a speaker_id that
+    /tts and /tts_batch accept in place of prompt_text + prompt_speech_file.
+    """
+    if MODELS["cosyvoice"] is None:
+        return jsonify({"error": "CosyVoice model is not loaded. Please try again later."}), 503
+
+    try:
+        if 'prompt_text' not in request.form or 'prompt_speech_file' not in request.files:
+            return jsonify({"error": "'prompt_text' and 'prompt_speech_file' are required."}), 400
+
+        prompt_text = request.form['prompt_text']
+        prompt_speech_file = request.files['prompt_speech_file']
+        prompt_speech_bytes = prompt_speech_file.read()
+        speaker_id = make_speaker_id(prompt_text, prompt_speech_bytes)
+        job = TTS_WORKER.submit(load_speaker, speaker_id, prompt_text, prompt_speech_bytes, prompt_speech_file.filename)
+        npz_path = job.result()
+
+        return with_timing(jsonify({"speaker_id": speaker_id, "npz_path": npz_path}), job), 200
+
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except Exception as e:
+        log.error(f"An error occurred during speaker registration: {e}", exc_info=True)
+        return jsonify({"error": "Failed to register speaker.", "details": str(e)}), 500
+
 @app.route('/rag_speakers', methods=['POST'])
 def run_rag_speakers():
     if MODELS["rag"] is None:
@@ -220,78 +833,61 @@ def run_rag_speakers():
         query_file = request.files['query_file']
         doc_file = request.files['doc_file']
 
-        # Save uploaded files to temporary files
-        with tempfile.NamedTemporaryFile(delete=False, mode='wb') as tmp_query_file:
-            query_file.save(tmp_query_file.name)
-            query_path = tmp_query_file.name
-        
-        with tempfile.NamedTemporaryFile(delete=False, mode='wb') as tmp_doc_file:
-            doc_file.save(tmp_doc_file.name)
-            doc_path = tmp_doc_file.name
-        
-        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp_output_file:
-            output_json_path = tmp_output_file.name
+        # Parse the uploads straight from the request stream
+        query_items = parse_query_items(query_file.read().decode('utf-8').splitlines())
+        doc_data = json.loads(doc_file.read().decode('utf-8'))
 
         log.info(f"Running RAG for query file: {query_file.filename} and doc file: {doc_file.filename}")
 
-        result = rag_speakers(
-            query_jsonl_path=query_path,
-            doc_json_path=doc_path,
-            output_json_path=output_json_path,
+        job = RAG_WORKER.submit(
+            match_speakers,
+            query_items,
+            doc_data,
             tokenizer=MODELS["rag"]['tokenizer'],
             model=MODELS["rag"]['model']
         )
-        
-        # Cleanup and send file
-        @after_this_request
-        def cleanup_rag(response):
-            try:
-                os.remove(query_path)
-                os.remove(doc_path)
-                os.remove(output_json_path)
-                log.info(f"Cleaned up temporary RAG files: {query_path}, {doc_path}, {output_json_path}")
-            except OSError as e:
-                log.error(f"Error cleaning up RAG files: {e}", exc_info=True)
-            return response
-            
-        return send_file(
-            output_json_path,
+        result = job.result()
+
+        return with_timing(send_file(
+            BytesIO(json.dumps(result, ensure_ascii=False, indent=2).encode('utf-8')),
             as_attachment=True,
             download_name='rag_match_results.json',
             mimetype='application/json'
-        )
+        ), job)
 
+    except QueueFullError as e:
+        return queue_full_response(e)
     except Exception as e:
         log.error(f"An error occurred during RAG execution: {e}", exc_info=True)
-        # Clean up temporary files on error
-        if 'query_path' in locals() and os.path.exists(query_path):
-            os.remove(query_path)
-        if 'doc_path' in locals() and os.path.exists(doc_path):
-            os.remove(doc_path)
-        if 'output_json_path' in locals() and os.path.exists(output_json_path):
-            os.remove(output_json_path)
         return jsonify({"error": "Failed to run RAG.", "details": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify that the service is running."""
-    audio_model_loaded = MODELS["mmaudio"] and MODELS["mmaudio"].get('net')
-    cosyvoice_model_loaded = MODELS["cosyvoice"] is not None
-    rag_model_loaded = MODELS["rag"] is not None
-    
-    models_status = {
-        "mmaudio": bool(audio_model_loaded), 
-        "cosyvoice": cosyvoice_model_loaded,
-        "rag": rag_model_loaded
-    }
-    
+    startup_status = STARTUP.status()
+    models_status = {name: status["state"] == "ready" for name, status in startup_status.items()}
+
     all_models_ok = all(models_status.values())
+    cache_status = {"tts": TTS_CACHE.stats(), "audio": AUDIO_CACHE.stats()}
+    queue_status = {
+        worker.name: {"depth": worker.depth, "max_depth": worker.max_queue_size}
+        for worker in (AUDIO_BATCHER, TTS_WORKER, RAG_WORKER)
+    }
+    body = {"models_loaded": models_status, "models": startup_status, "cache": cache_status, "queues": queue_status}
 
     if all_models_ok:
-        return jsonify({"status": "ok", "models_loaded": models_status}), 200
+        return jsonify({"status": "ok", **body}), 200
+    elif any(status["state"] in ("pending", "loading", "warming") for status in startup_status.values()):
+        return jsonify({"status": "loading", **body}), 503
     else:
-        return jsonify({"status": "partially_loaded" if any(models_status.values()) else "error", "models_loaded": models_status}), 503
+        return jsonify({"status": "partially_loaded" if any(models_status.values()) else "error", **body}), 503
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    """Prometheus text-format metrics."""
+    return Response(METRICS.render(), content_type=METRICS.content_type)
 
 if __name__ == '__main__':
-    load_models()  # Load all models before starting the server
-    app.run(host='0.0.0.0', port=8000, debug=False)
+    # Start serving right away; each model's routes answer 503 until that model is ready
+    load_models(wait=False)
+    app.run(host='0.0.0.0', port=8000, debug=False, threaded=True)
@@ -0,0 +1,84 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ModelStartup:
+    """
+    Loads independent models concurrently, one background thread per model.
+
+    Each model is published into `models[name]` only after its loader (and optional warm-up)
+    has finished, so routes that check `models[name] is None` start serving that model while
+    the others are still loading. A loader returning None or raising marks the model failed.
+    Per-model state and load / warm-up timings are available from status().
+    """
+
+    def __init__(self, models, loaders, warmups=None):
+        self.models = models
+        self.loaders = loaders
+        self.warmups = warmups or {}
+        self._status = {
+            name: {"state": "pending", "load_seconds": None, "warmup_seconds": None, "error": None}
+            for name in loaders
+        }
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start loading every model that is not loaded or loading yet; returns immediately."""
+        with self._lock:
+            for name in self.loaders:
+                if name in self._threads or self.models.get(name) is not None:
+                    continue
+                thread = threading.Thread(target=self._load, args=(name,), name=f'load-{name}', daemon=True)
+                self._threads[name] = thread
+                thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in list(self._threads.values()):
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def _set(self, name, **fields):
+        with self._lock:
+            self._status[name].update(fields)
+
+    def _load(self, name):
+        log.info(f"Loading {name} model...")
+        self._set(name, state="loading")
+        started_at = time.monotonic()
+        try:
+            model = self.loaders[name]()
+            if model is None:
+                raise RuntimeError("loader returned no model")
+        except Exception as e:
+            log.error(f"Error loading {name} model: {e}", exc_info=True)
+            self._set(name, state="failed", load_seconds=time.monotonic() - started_at, error=str(e))
+            return
+        load_seconds = time.monotonic() - started_at
+        log.info(f"{name.capitalize()} model loaded in {load_seconds:.1f}s.")
+        self._set(name, load_seconds=load_seconds)
+
+        warmup = self.warmups.get(name)
+        if warmup is not None:
+            self._set(name, state="warming")
+            started_at = time.monotonic()
+            try:
+                warmup(model)
+            except Exception as e:
+                # A failed warm-up only costs latency on the first real request
+                log.warning(f"Warm-up of {name} model failed: {e}", exc_info=True)
+                self._set(name, error=f"warm-up failed: {e}")
+            warmup_seconds = time.monotonic() - started_at
+            log.info(f"{name.capitalize()} model warmed up in {warmup_seconds:.1f}s.")
+            self._set(name, warmup_seconds=warmup_seconds)
+
+        self.models[name] = model
+        self._set(name, state="ready")
+
+    def status(self):
+        with self._lock:
+            return {name: dict(status) for name, status in self._status.items()}
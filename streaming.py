@@ -0,0 +1,165 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import json5
+
+from api import rag
+from code_generation import normalize_audio_type
+
+
+class JSON5ObjectSplitter:
+    """
+    从 LLM 的增量输出中切出完整的顶层 JSON5 对象。
+
+    只跟踪花括号深度、字符串状态（支持单/双引号与转义）与 JSON5 注释（// 与 /* */），
+    注释与字符串中的花括号不计入深度；对象之外的内容（```json 代码块标记、外层 [ ]、逗号等）一律忽略。
+    状态在 feed 之间保留，注释或字符串跨越分块边界也能正确切分。
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._pos = 0
+        self._depth = 0
+        self._start = None
+        self._quote = None
+        self._escape = False
+        self._comment = None  # None / '//' / '/*'
+
+    def feed(self, chunk):
+        """追加一段文本，返回本次新完成的对象字符串列表。"""
+        self._buffer += chunk
+        objects = []
+        while self._pos < len(self._buffer):
+            ch = self._buffer[self._pos]
+            if self._comment == '//':
+                if ch == '\n':
+                    self._comment = None
+            elif self._comment == '/*':
+                if ch == '*':
+                    # '*' 在缓冲区末尾时等下一块再判断是否为 */
+                    if self._pos + 1 == len(self._buffer):
+                        break
+                    if self._buffer[self._pos + 1] == '/':
+                        self._comment = None
+                        self._pos += 1
+            elif self._quote is not None:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == self._quote:
+                    self._quote = None
+            elif ch == '/':
+                # '/' 在缓冲区末尾时等下一块再判断是否为注释开头
+                if self._pos + 1 == len(self._buffer):
+                    break
+                if self._buffer[self._pos + 1] in '/*':
+                    self._comment = self._buffer[self._pos:self._pos + 2]
+                    self._pos += 1
+            elif self._depth == 0:
+                if ch == '{':
+                    self._start = self._pos
+                    self._depth = 1
+            elif ch in ('"', "'"):
+                self._quote = ch
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    objects.append(self._buffer[self._start:self._pos + 1])
+                    self._start = None
+            self._pos += 1
+
+        # 丢弃已消费的前缀，只保留未完成的对象
+        keep_from = self._start if self._start is not None else self._pos
+        self._buffer = self._buffer[keep_from:]
+        self._pos -= keep_from
+        if self._start is not None:
+            self._start = 0
+        return objects
+
+
+class StreamingScriptRenderer:
+    """
+    把逐条到达的 Step2 配音条目直接送入 RenderScheduler。
+
+    - 前景条目按到达顺序编号并立即提交生成；
+    - 新出现的说话人在后台线程上单独做一次 RAG 匹配（匹配对每个说话人独立，结果与整体匹配一致），
+      该说话人的片段在匹配完成后才计算内容哈希并提交 TTS，接收 LLM 输出不被匹配阻塞；
+    - 背景音在 start 时提交种子片段生成，stop 到达后补全区间。
+    """
+
+    def __init__(self, scheduler, doc_file_path, output_dir):
+        self.scheduler = scheduler
+        self.doc_file_path = doc_file_path
+        self.output_dir = str(output_dir)
+        self.items = []
+        self.char_to_voice_map = scheduler.char_to_voice_map
+        self._fg_audio_id = 0
+        self._open_bgs = {}
+        # 匹配串行执行：共用一组查询/结果文件，也不与 TTS 争抢 RAG 服务
+        self._match_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rag')
+        self._matches = {}  # 说话人 -> 匹配 Future
+
+    def _match_speaker(self, item):
+        """返回该说话人的匹配 Future；已在映射中时返回 None。同一说话人只匹配一次。"""
+        speaker = item['character']
+        if speaker in self._matches:
+            return self._matches[speaker]
+        if speaker in self.char_to_voice_map:
+            return None
+        future = self._match_pool.submit(self._run_match, dict(item), speaker)
+        self._matches[speaker] = future
+        return future
+
+    def _run_match(self, item, speaker):
+        query_path = os.path.join(self.output_dir, "rag_query.jsonl")
+        result_path = os.path.join(self.output_dir, "rag_result.json")
+        with open(query_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({**item, "speaker": speaker}, ensure_ascii=False) + '\n')
+        rag(query_path, self.doc_file_path, result_path)
+        with open(result_path, 'r', encoding='utf-8') as f:
+            self.char_to_voice_map.update(json5.load(f))
+        os.remove(query_path)
+        os.remove(result_path)
+
+    def close(self):
+        """等待所有说话人匹配结束（匹配失败由对应片段记录）。"""
+        self._match_pool.shutdown(wait=True)
+
+    def add_item(self, item):
+        self.items.append(dict(item))
+
+        # 与 collect_and_check_audio_data 相同的字段补全
+        item['audio_type'] = normalize_audio_type(item['audio_type'])
+        if 'character' not in item and 'speaker' in item:
+            item['character'] = item['speaker']
+        if 'len' not in item and 'duration' in item:
+            item['len'] = item['duration']
+
+        if item['layout'] == 'foreground':
+            item['id'] = self._fg_audio_id
+            self._fg_audio_id += 1
+            match = self._match_speaker(item) if item['audio_type'] == 'speech' else None
+            self.scheduler.add_foreground(item, after=match)
+        elif item['action'] == 'start':
+            item['begin_fg_audio_id'] = self._fg_audio_id
+            self._open_bgs[item['id']] = (item, self.scheduler.start_background(item))
+        elif item['action'] == 'stop':
+            if item['id'] not in self._open_bgs:
+                raise ValueError(f"Stop without start: id={item['id']}")
+            bg_audio, clip = self._open_bgs.pop(item['id'])
+            if bg_audio['begin_fg_audio_id'] == self._fg_audio_id:
+                raise ValueError(f'background audio contains no foreground audio, audio={bg_audio}')
+            self.scheduler.stop_background(clip, self._fg_audio_id)
+
+    def feed(self, splitter, chunk):
+        for text in splitter.feed(chunk):
+            try:
+                item = json5.loads(text)
+            except Exception as e:
+                print(f"Warning: Could not parse streamed object as JSON5: {text} - {e}")
+                continue
+            self.add_item(item)
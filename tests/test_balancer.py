@@ -0,0 +1,69 @@
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from balancer import EndpointPool
+
+URLS = ["http://tts-a:8000", "http://tts-b:8000", "http://tts-c:8000"]
+
+
+@pytest.fixture(autouse=True)
+def no_health_thread(monkeypatch):
+    # 节点地址不可达，后台健康检查会把它们全部标记为不健康
+    monkeypatch.setattr(EndpointPool, "_ensure_health_thread", lambda self: None)
+
+
+def test_least_outstanding():
+    pool = EndpointPool(URLS)
+    with pool.acquire() as first, pool.acquire() as second:
+        assert first is not second
+        assert pool.route() not in (first, second)
+    assert all(endpoint.outstanding == 0 for endpoint in pool.endpoints)
+
+
+def test_affinity_is_stable():
+    pool = EndpointPool(URLS)
+    routed = {speaker: pool.route(speaker) for speaker in ("narrator", "alice", "bob", "carol")}
+    assert all(pool.route(speaker) is endpoint for speaker, endpoint in routed.items())
+    assert EndpointPool(URLS).route("alice").url == routed["alice"].url
+
+
+def test_affinity_overflows_when_overloaded():
+    pool = EndpointPool(URLS)
+    home = pool.route("alice")
+    home.outstanding = 10
+    assert pool.route("alice") is not home
+
+
+def test_network_error_ejects_endpoint():
+    pool = EndpointPool(URLS)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        with pool.acquire("alice") as endpoint:
+            raise requests.exceptions.ConnectionError()
+    assert endpoint.outstanding == 0
+    assert all(pool.route(speaker) is not endpoint for speaker in ("alice", "bob", "carol", None))
+
+
+def test_report_ejects_on_5xx_and_429():
+    pool = EndpointPool(URLS[:2])
+    a, b = pool.endpoints
+    pool.report(a, 503)
+    assert pool.route() is b
+    pool.report(b, 429, retry_after="0")
+    pool.report(a, 200)
+    assert pool.route() is b
+
+
+def test_all_ejected_falls_back_to_every_endpoint():
+    pool = EndpointPool(URLS)
+    for endpoint in pool.endpoints:
+        pool.eject(endpoint)
+    assert pool.route() in pool.endpoints
+
+
+def test_set_endpoints_keeps_state():
+    pool = EndpointPool(URLS[:2])
+    pool.eject(pool.endpoints[0])
+    pool.set_endpoints(URLS)
+    assert pool.urls == URLS
+    assert pool.route() is not pool.endpoints[0]
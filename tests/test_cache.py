@@ -0,0 +1,37 @@
+import os
+
+from cache import DiskLRUCache, make_cache_key
+
+
+def test_put_get_roundtrip_and_lru_eviction(tmp_path):
+    cache = DiskLRUCache(tmp_path, max_bytes=10)
+    cache.put("aa01", b"12345")
+    cache.put("bb02", b"67890")
+    assert cache.get("aa01") == b"12345"  # aa01 变为最近使用
+    cache.put("cc03", b"abcde")
+    assert cache.get("bb02") is None
+    assert cache.get("aa01") == b"12345"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_startup_scan_restores_entries(tmp_path):
+    DiskLRUCache(tmp_path, max_bytes=100).put(make_cache_key("x"), b"data")
+    reopened = DiskLRUCache(tmp_path, max_bytes=100)
+    assert reopened.get(make_cache_key("x")) == b"data"
+    assert reopened.stats()["bytes"] == 4
+
+
+def test_startup_scan_removes_orphaned_tmp_files(tmp_path):
+    shard = tmp_path / "ab"
+    shard.mkdir()
+    dead_pid = 2 ** 22 + 12345  # 超出 Linux pid 上限，不可能存在
+    orphan = shard / f"abcd.bin.{dead_pid}.1.tmp"
+    orphan.write_bytes(b"x" * 100)
+    live = shard / f"abce.bin.{os.getpid()}.1.tmp"
+    live.write_bytes(b"y")
+
+    cache = DiskLRUCache(tmp_path, max_bytes=1000)
+    assert not orphan.exists()
+    assert live.exists()  # 仍在运行的进程正在写的文件保留
+    assert cache.stats()["entries"] == 0
+    assert cache.stats()["bytes"] == 0
@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+for module in ("json5", "numpy", "scipy", "soundfile", "torchaudio", "pyloudnorm"):
+    pytest.importorskip(module)
+
+from manifest import REUSE_DIRNAME, RunJournal, RunManifest, clip_content_hash, file_checksum
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+    path = tmp_path / "audio"
+    path.mkdir()
+    return str(path)
+
+
+def previous_run(tmp_path, wav_path):
+    """模拟上次运行：两个片段已生成并记录在清单中。"""
+    manifest = RunManifest(tmp_path / "manifest.json")
+    for key, name in (("k1", "fg_speech_0_a.wav"), ("k2", "fg_speech_1_b.wav")):
+        wav_file = os.path.join(wav_path, name)
+        write(wav_file, key.encode())
+        manifest.record(key, wav_path, wav_file, 1.5)
+    manifest.save()
+    return manifest
+
+
+def test_stage_adopt_finalize(tmp_path, wav_path):
+    previous_run(tmp_path, wav_path)
+    manifest = RunManifest.load(tmp_path / "manifest.json")
+    manifest.stage(wav_path)
+    assert not os.path.exists(os.path.join(wav_path, "fg_speech_0_a.wav"))
+    assert manifest.lookup("k1", wav_path)["wav"] == os.path.join(REUSE_DIRNAME, "k1.wav")
+
+    # 新运行中 k2 排到了第一个位置，复用时不能被旧文件名覆盖
+    new_file = os.path.join(wav_path, "fg_speech_0_b.wav")
+    assert manifest.adopt("k2", wav_path, new_file) == 1.5
+    with open(new_file, 'rb') as f:
+        assert f.read() == b"k2"
+
+    manifest.finalize(wav_path, keep={"k2"})
+    assert manifest.entries == {"k2": {"wav": "fg_speech_0_b.wav", "len": 1.5, "sha256": file_checksum(new_file)}}
+    assert not os.path.exists(os.path.join(wav_path, REUSE_DIRNAME))
+    assert RunManifest.load(tmp_path / "manifest.json").entries == manifest.entries
+
+
+def test_load_merges_journal(tmp_path, wav_path):
+    journal = RunJournal(tmp_path / "journal.jsonl")
+    manifest = RunManifest(tmp_path / "manifest.json", journal=journal)
+    wav_file = os.path.join(wav_path, "fg_speech_0_a.wav")
+    write(wav_file, b"data")
+    manifest.record("k1", wav_path, wav_file, 2.0)
+    # 崩溃时写了一半的行被忽略
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"key": "k2", "wav"')
+
+    loaded = RunManifest.load(tmp_path / "manifest.json", journal=journal)
+    assert list(loaded.entries) == ["k1"]
+
+
+def test_load_validate_drops_missing_and_modified(tmp_path, wav_path):
+    previous_run(tmp_path, wav_path)
+    write(os.path.join(wav_path, "fg_speech_0_a.wav"), b"changed")
+    manifest = RunManifest.load(tmp_path / "manifest.json", wav_path=wav_path, validate=True)
+    assert list(manifest.entries) == ["k2"]
+
+    os.remove(os.path.join(wav_path, "fg_speech_1_b.wav"))
+    manifest = RunManifest.load(tmp_path / "manifest.json", wav_path=wav_path, validate=True)
+    assert manifest.entries == {}
+
+
+def test_default_quality_hashes_like_final():
+    clip = {'audio_type': 'sound_effect', 'layout': 'foreground', 'desc': 'rain', 'vol': 1, 'len': 3}
+    assert clip_content_hash(clip, {}) == clip_content_hash(clip, {}, quality="final")
+    assert clip_content_hash(clip, {}) != clip_content_hash(clip, {}, quality="draft")
@@ -0,0 +1,73 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+for module in ("requests", "json5", "numpy", "scipy", "soundfile", "torchaudio", "pyloudnorm"):
+    pytest.importorskip(module)
+
+from scheduler import RenderScheduler
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    s = RenderScheduler(tmp_path / "audio", char_to_voice_map={})
+    yield s
+    s.shutdown()
+
+
+@pytest.fixture
+def pool():
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        yield executor
+
+
+def test_when_all_passes_results_in_order(scheduler, pool):
+    a, b = Future(), Future()
+    result = scheduler._when_all([a, b], lambda x, y: x - y, pool)
+    b.set_result(1)
+    assert not result.done()
+    a.set_result(10)
+    assert result.result(timeout=5) == 9
+
+
+def test_when_all_without_deps_runs_immediately(scheduler, pool):
+    assert scheduler._when_all([], lambda: "done", pool).result(timeout=5) == "done"
+
+
+def test_when_all_propagates_dependency_failure(scheduler, pool):
+    calls = []
+    ok, failed = Future(), Future()
+    result = scheduler._when_all([ok, failed], lambda *args: calls.append(args), pool)
+    ok.set_result(1)
+    failed.set_exception(RuntimeError("TTS 生成失败"))
+    with pytest.raises(RuntimeError, match="TTS 生成失败"):
+        result.result(timeout=5)
+    assert calls == []
+
+
+def test_when_all_propagates_failure_of_fn(scheduler, pool):
+    def boom(_):
+        raise ValueError("mix failed")
+
+    dep = scheduler._resolved(1)
+    with pytest.raises(ValueError, match="mix failed"):
+        scheduler._when_all([dep], boom, pool).result(timeout=5)
+
+
+def test_failure_propagates_through_chained_dependencies(scheduler, pool):
+    root = Future()
+    middle = scheduler._when_all([root], lambda x: x + 1, pool)
+    final = scheduler._when_all([middle], lambda x: x * 2, pool)
+    root.set_exception(OSError("clip missing"))
+    with pytest.raises(OSError, match="clip missing"):
+        final.result(timeout=5)
+
+
+def test_add_foreground_waits_for_after(scheduler):
+    after = Future()
+    length = scheduler.add_foreground({'layout': 'foreground', 'audio_type': 'speech', 'character': 'A', 'text': 'x', 'vol': 1}, after=after)
+    assert not length.done()
+    after.set_exception(RuntimeError("rag down"))
+    with pytest.raises(RuntimeError, match="rag down"):
+        length.result(timeout=5)
+    assert [str(e) for _, e in scheduler._failures] == ["rag down"]
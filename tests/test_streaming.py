@@ -0,0 +1,38 @@
+import pytest
+
+for module in ("requests", "json5", "numpy", "scipy", "soundfile", "torchaudio", "pyloudnorm"):
+    pytest.importorskip(module)
+
+from streaming import JSON5ObjectSplitter
+
+SCRIPT = (
+    '```json\n[ // 说明 {不是对象}\n'
+    ' {"text": "a}b", /* } { */ \'vol\': 1},\n'
+    ' {"desc": {"inner": "\\"}"}}, // 结尾 }\n'
+    ']\n```'
+)
+EXPECTED = ['{"text": "a}b", /* } { */ \'vol\': 1}', '{"desc": {"inner": "\\"}"}}']
+
+
+def split(text, size):
+    splitter = JSON5ObjectSplitter()
+    objects = []
+    for i in range(0, len(text), size):
+        objects += splitter.feed(text[i:i + size])
+    return objects
+
+
+def test_whole_input():
+    assert split(SCRIPT, len(SCRIPT)) == EXPECTED
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 16])
+def test_chunk_boundaries(size):
+    assert split(SCRIPT, size) == EXPECTED
+
+
+def test_objects_returned_as_soon_as_complete():
+    splitter = JSON5ObjectSplitter()
+    assert splitter.feed('[{"a": 1}, {"b": ') == ['{"a": 1}']
+    assert splitter.feed('2}') == ['{"b": 2}']
+    assert splitter.feed(']') == []
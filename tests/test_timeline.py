@@ -0,0 +1,44 @@
+import pytest
+
+for module in ("numpy", "scipy", "soundfile"):
+    pytest.importorskip(module)
+
+import numpy as np
+import soundfile as sf
+
+from timeline import Timeline
+
+
+def test_prefix_sums():
+    timeline = Timeline([100, 250, 50], [(0, 2), (1, 3)])
+    assert list(timeline.starts) == [0, 100, 350, 400]
+    assert len(timeline) == 3
+    assert timeline.total == 400
+    assert list(timeline.fg_lengths) == [100, 250, 50]
+    assert [timeline.offset(i) for i in range(4)] == [0, 100, 350, 400]
+    assert timeline.span(*timeline.bg_spans[0]) == (0, 350)
+    assert timeline.span(*timeline.bg_spans[1]) == (100, 300)
+
+
+def test_empty():
+    timeline = Timeline([])
+    assert timeline.total == 0
+    assert len(timeline.bg_spans) == 0
+
+
+@pytest.mark.parametrize("span", [(0, 4), (-1, 1), (2, 1)])
+def test_span_out_of_range(span):
+    with pytest.raises(ValueError):
+        Timeline([1, 2, 3], [span])
+
+
+def test_from_wavs_uses_exact_frames(tmp_path):
+    wavs = []
+    for i, (frames, sr) in enumerate([(24001, 24000), (44101, 44100), (7, 24000)]):
+        path = str(tmp_path / f"{i}.wav")
+        sf.write(path, np.zeros(frames, dtype=np.float32), sr)
+        wavs.append(path)
+    timeline = Timeline.from_wavs(wavs, [(0, 3)], sr=24000)
+    # 44100 -> 24000 Hz: ceil(44101 * 80 / 147)
+    assert list(timeline.fg_lengths) == [24001, 24001, 7]
+    assert timeline.span(0, 3) == (0, 48009)
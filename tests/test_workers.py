@@ -0,0 +1,100 @@
+import contextlib
+import logging
+import threading
+
+import pytest
+
+from workers import BatchingWorker, ModelWorker, QueueFullError
+
+
+def blocked_worker(**kwargs):
+    """Worker whose first batch blocks until the returned event is set."""
+    release = threading.Event()
+    started = threading.Event()
+
+    def run_batch(items):
+        started.set()
+        release.wait(5)
+        return items
+
+    worker = BatchingWorker('test', run_batch, max_wait=0.01, **kwargs)
+    return worker, started, release
+
+
+def test_batches_group_by_key():
+    batches = []
+    worker = BatchingWorker('test', lambda items: batches.append(items) or items, group_key=lambda item: item[0],
+                            max_batch_size=4, max_wait=0.1)
+    futures = [worker.submit(item) for item in ['a1', 'b1', 'a2', 'b2']]
+    assert [f.result(timeout=5) for f in futures] == ['a1', 'b1', 'a2', 'b2']
+    assert sorted(batches) == [['a1', 'a2'], ['b1', 'b2']]
+
+
+def test_queue_full_raises():
+    worker, started, release = blocked_worker(max_batch_size=1, max_queue_size=2)
+    running = worker.submit(0)
+    assert started.wait(5)
+    waiting = [worker.submit(1), worker.submit(2)]
+    with pytest.raises(QueueFullError) as info:
+        worker.submit(3)
+    assert info.value.depth == 2
+    assert info.value.retry_after >= 1
+
+    release.set()
+    assert [f.result(timeout=5) for f in [running] + waiting] == [0, 1, 2]
+    # Slots are released once requests enter a batch
+    assert worker.submit(4).result(timeout=5) == 4
+
+
+def test_held_back_requests_count_toward_capacity():
+    started = {item: threading.Event() for item in 'xabc'}
+    release = {item: threading.Event() for item in 'xabc'}
+
+    def run_batch(items):
+        started[items[0]].set()
+        release[items[0]].wait(5)
+        return items
+
+    worker = BatchingWorker('test', run_batch, group_key=lambda item: item, max_batch_size=2, max_wait=0.05,
+                            max_queue_size=2)
+    worker.submit('x')
+    assert started['x'].wait(5)
+    worker.submit('a')
+    worker.submit('b')
+    release['x'].set()
+    # The batch for 'a' parks 'b' in _pending: it still holds its slot, so only one slot is free
+    assert started['a'].wait(5)
+    assert worker.depth == 1
+    worker.submit('c')
+    with pytest.raises(QueueFullError):
+        worker.submit('d')
+    for event in release.values():
+        event.set()
+
+
+def test_errors_are_passed_to_the_future_without_logging(caplog):
+    worker = ModelWorker('test')
+
+    def lookup():
+        raise KeyError('unknown speaker_id')
+
+    with caplog.at_level(logging.DEBUG, logger='workers'):
+        future = worker.submit(lookup)
+        with pytest.raises(KeyError):
+            future.result(timeout=5)
+    assert caplog.records == []
+    assert future.compute_time >= 0
+
+
+def test_batch_context_wraps_each_batch():
+    events = []
+
+    @contextlib.contextmanager
+    def section(name):
+        events.append(('enter', name))
+        yield
+        events.append(('exit', name))
+
+    worker = ModelWorker('rag', batch_context=section)
+    assert worker.submit(lambda: events.append('run')).result(timeout=5) is None
+    assert events == [('enter', 'rag'), 'run', ('exit', 'rag')]
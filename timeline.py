@@ -0,0 +1,54 @@
+import numpy as np
+
+from mixer import SAMPLE_RATE, probe_length
+
+
+class Timeline:
+    """
+    以整数采样点表示的前景时间轴。
+
+    前景片段依次拼接，starts 为长度的 int64 前缀和（starts[i] 为第 i 个前景片段的起点，starts[-1] 为总长）；
+    背景片段由 collect_and_check_audio_data 给出的 [begin_fg_audio_id, end_fg_audio_id) 区间定位，
+    起点与长度都是 O(1) 查询，没有浮点秒数的累积误差。
+    """
+
+    def __init__(self, fg_lengths, bg_spans=(), sr=SAMPLE_RATE):
+        """
+        Args:
+            fg_lengths: 每个前景片段的采样点数。
+            bg_spans: 每个背景片段的 (begin_fg_audio_id, end_fg_audio_id)。
+            sr (int): 采样率。
+        """
+        self.sr = sr
+        lengths = np.asarray(fg_lengths, dtype=np.int64)
+        self.starts = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.starts[1:])
+        spans = np.asarray(list(bg_spans), dtype=np.int64).reshape(-1, 2)
+        if len(spans) and (spans.min() < 0 or spans.max() > len(lengths) or np.any(spans[:, 0] > spans[:, 1])):
+            raise ValueError(f"background span out of range for {len(lengths)} foreground clips")
+        self.bg_spans = spans
+
+    @classmethod
+    def from_wavs(cls, fg_wavs, bg_spans=(), sr=SAMPLE_RATE):
+        """只读前景片段的文件头构建，长度是重采样到 sr 后的精确采样点数。"""
+        return cls([probe_length(wav, sr) for wav in fg_wavs], bg_spans, sr=sr)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    @property
+    def total(self):
+        return int(self.starts[-1])
+
+    @property
+    def fg_lengths(self):
+        return np.diff(self.starts)
+
+    def offset(self, fg_id):
+        """第 fg_id 个前景片段的起始采样点；fg_id == len(self) 时为总长。"""
+        return int(self.starts[fg_id])
+
+    def span(self, begin_id, end_id):
+        """前景区间 [begin_id, end_id) 的 (起始采样点, 长度)。"""
+        start = int(self.starts[begin_id])
+        return start, int(self.starts[end_id]) - start
@@ -1,12 +1,8 @@
-import torchaudio
 import soundfile as sf 
 import pyloudnorm as pyln
 import numpy as np
 import re
-from scipy.io.wavfile import write
-from pydub import AudioSegment
-import math
-import random
+from mixer import stream_mix, stream_cat, probe_length, LoopSource
 SAMPLE_RATE = 24000
 def LOUDNESS_NORM(audio_data: np.ndarray, sr=24000, target_lufs=-25.0, peak_norm_db=-1.0):
     """
@@ -46,80 +42,26 @@ def LOUDNESS_NORM(audio_data: np.ndarray, sr=24000, target_lufs=-25.0, peak_norm
     return normalized_audio_final
 
 
-def READ_AUDIO_NUMPY(wav, sr=SAMPLE_RATE):
-    """
-    function: read audio numpy 
-    return: np.array [samples]
-    """
-    waveform, sample_rate = torchaudio.load(wav)
-
-    if sample_rate != sr:
-        waveform = torchaudio.functional.resample(waveform, orig_freq=sample_rate, new_freq=sr)
-    
-    wav_numpy = waveform[0].numpy()
-
-    return wav_numpy
-
-
-def WRITE_AUDIO(wav, name=None, sr=SAMPLE_RATE):
-    """
-    function: write audio numpy to .wav file
-    @params:
-        wav: np.array [samples]
-    """   
-    if name is None:
-        name = 'output.wav' 
-    
-    if len(wav.shape) > 1:
-        wav = wav[0]
-
-    # declipping
-    
-    max_value = np.max(np.abs(wav))
-    if max_value > 1:
-        wav *= 0.9 / max_value
-    
-    # write audio
-    write(name, sr, np.round(wav*32767).astype(np.int16))
-
-
-
-def MIX(wavs=[['1.wav', 0.], ['2.wav', 10.]], out_wav='out.wav', sr=SAMPLE_RATE):
+def MIX(wavs=[['1.wav', 0.], ['2.wav', 10.]], out_wav='out.wav', sr=SAMPLE_RATE, samples=False):
     """
     wavs:[[wav_name, absolute_offset], ...]
+    absolute_offset 默认以秒计；samples 为 True 时为整数采样点（如 timeline.Timeline.span 的结果）。
+    按块流式混音（见 mixer.stream_mix），只读文件头确定总长，内存占用与总时长无关。
     """
-
-    max_length = max([int(wav[1]*sr + len(READ_AUDIO_NUMPY(wav[0]))) for wav in wavs])
-    template_wav = np.zeros(max_length)
-
-    for wav in wavs:
-        cur_name, cur_offset = wav
-        cur_wav = READ_AUDIO_NUMPY(cur_name)
-        cur_len = len(cur_wav)
-        cur_offset = int(cur_offset * sr)
-        
-        # mix
-        template_wav[cur_offset:cur_offset+cur_len] += cur_wav
-    
-    WRITE_AUDIO(template_wav, name=out_wav)
+    if not samples:
+        wavs = [(wav_name, int(offset * sr)) for wav_name, offset in wavs]
+    stream_mix(wavs, out_wav, sr=sr)
 
 
-def CAT(wavs, out_wav='out.wav'):
+def CAT(wavs, out_wav='out.wav', return_offsets=False):
     """
     wavs: List of wav file ['1.wav', '2.wav', ...]
+    按文件头长度预先确定每个片段的位置，逐块写出（见 mixer.stream_cat）。
+    return_offsets 为 True 时返回各片段的起始采样点（24kHz），末尾为总长度。
     """
-    wav_num = len(wavs)
-
-    segment0 = READ_AUDIO_NUMPY(wavs[0])
-
-    cat_wav = segment0
-
-    if wav_num > 1:
-        for i in range(1, wav_num):
-            next_wav = READ_AUDIO_NUMPY(wavs[i])
-            cat_wav = np.concatenate((cat_wav, next_wav), axis=-1)
-
-    WRITE_AUDIO(cat_wav, name=out_wav)
+    offsets = stream_cat(wavs, out_wav, sr=SAMPLE_RATE)
+    if return_offsets:
+        return offsets
 
 
 def RESAMPLE(input_path: str, output_path: str):
@@ -138,38 +80,21 @@ def RESAMPLE(input_path: str, output_path: str):
 
 def LOOP(input_wav_path, output_wav_path, target_length_sec):
     """
-    循环输入音频直到目标长度，并添加随机渐入渐出效果，保存为新音频文件。
+    循环输入音频直到目标长度，接缝处等功率交叉淡化，并添加随机渐入渐出效果，保存为新音频文件。
+    使用 NumPy 向量化实现（见 mixer.LoopSource），在输入采样率下处理第一声道；
+    混音时可直接把 LoopSource 交给 MIX，无需写出中间文件。
 
     参数:
         input_wav_path (str): 输入音频路径（.wav）
-        output_wav_path (str): 输出音频路径（.wav）
+        output_wav_path (str): 输出音频路径（.wav），可与输入相同
         target_length_sec (float): 目标时长（秒）
     """
-    # 加载音频
-    audio = AudioSegment.from_wav(input_wav_path)
-    input_len_ms = len(audio)
-    target_len_ms = int(target_length_sec * 1000)
-
-    # 如果原音频足够长，直接截断；否则重复
-    if input_len_ms >= target_len_ms:
-        looped_audio = audio[:target_len_ms]
-    else:
-        repeat_times = math.ceil(target_len_ms / input_len_ms)
-        looped_audio = audio * repeat_times
-        looped_audio = looped_audio[:target_len_ms]
-
-    # 随机渐入和渐出时长（单位：毫秒）
-    fade_in_ms = int(random.uniform(2.5, 3.5) * 1000)
-    fade_out_ms = int(random.uniform(2.5, 3.5) * 1000)
-
-    # 添加渐入渐出
-    faded_audio = looped_audio.fade_in(fade_in_ms).fade_out(fade_out_ms)
-
-    # 导出
-    faded_audio.export(output_wav_path, format="wav")
+    seed, sr = sf.read(input_wav_path, dtype='float32', always_2d=True)
+    bed = LoopSource(seed[:, 0], int(target_length_sec * sr), sr=sr)
+    sf.write(output_wav_path, bed.read(bed.length), sr, subtype='PCM_16')
 
 def COMPUTE_LEN(wav):
-    wav= READ_AUDIO_NUMPY(wav)
-    return len(wav) / 24000
+    """只读文件头计算时长（秒），按 24kHz 采样点数换算；结果与 MIX / CAT 共用文件头缓存。"""
+    return probe_length(wav, SAMPLE_RATE) / SAMPLE_RATE
 def text_to_abbrev_prompt(input_text):
     return re.sub(r'[^a-zA-Z_]', '', '_'.join(input_text.split()[:5]))
\ No newline at end of file
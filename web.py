@@ -41,6 +41,12 @@ with gr.Blocks(title="AudiobookAgent 配音演示", theme=gr.themes.Soft()) as d
                     placeholder="可选：将配音脚本内容粘贴于此，可跳过所有分析步骤，直接合成。\n注意：请确保配音脚本内容格式正确，否则可能导致音频生成失败。",
                 )
 
+                quality_input = gr.Radio(
+                    label="🎚️ 音效质量",
+                    choices=[("草稿（快速预览）", "draft"), ("定稿（完整质量）", "final")],
+                    value="final",
+                )
+
             run_button = gr.Button("▶️ 生成并播放", variant="primary")
 
         with gr.Column(scale=2, min_width=500):
@@ -107,18 +113,19 @@ with gr.Blocks(title="AudiobookAgent 配音演示", theme=gr.themes.Soft()) as d
 
     run_button.click(
         fn=wrapped_pipeline,
-        inputs=[text_input, step1_input, step2_input],
+        inputs=[text_input, step1_input, step2_input, quality_input],
         outputs=[status_text, log_output, audio_output],
     )
 
 
-def run_pipeline(text: str, step1_content: str, step2_content: str):
+def run_pipeline(text: str, step1_content: str, step2_content: str, quality: str = "final"):
     """包装 AudiobookAgent/pipeline.py，实时流式返回日志并最终给出音频路径。
 
     参数说明：
         text:            传给 --text 的主题内容（可为空）。
         step1_content:   若提供则写入临时文件并作为 --step1_file（优先生效）。
         step2_content:   若提供则写入临时文件并作为 --step2_file（最高优先级）。
+        quality:         传给 --quality 的音效质量档位（draft / final）。
 
     生成器产出：
         Tuple[str, str]: (实时日志字符串, 最终音频文件路径或 None)。
@@ -155,6 +162,8 @@ def run_pipeline(text: str, step1_content: str, step2_content: str):
         return
 
     cmd.extend(["--output_path", output_path])
+    if quality:
+        cmd.extend(["--quality", quality])
 
     # 启动子进程，合并 stdout/stderr 以便统一展示
     proc = subprocess.Popen(
@@ -0,0 +1,143 @@
+import contextlib
+import functools
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised by submit() when a worker's queue is at capacity."""
+
+    def __init__(self, name, depth, retry_after):
+        super().__init__(f"{name} queue is full ({depth} waiting), retry in {retry_after}s")
+        self.name = name
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class BatchingWorker:
+    """
+    Single GPU worker thread that groups concurrent requests into batches.
+
+    Requests are collected for up to `max_wait` seconds (or until `max_batch_size` is reached);
+    only requests with the same `group_key(item)` share a batch, others wait for the next round.
+    `run_batch(items)` must return one result per item, in order.
+
+    At most `max_queue_size` requests may wait, including those held back for a later batch because
+    their group key differs; beyond that submit() raises QueueFullError so the caller can shed load
+    instead of piling up requests. Each returned future carries `queue_time` and `compute_time`
+    (seconds) once it is done; `on_batch(name, queue_times, compute_time)` is called after every
+    batch, e.g. to export metrics. `batch_context(name)`, if given, returns a context manager entered
+    around each `run_batch` call, e.g. to measure GPU memory per model. If `run_batch` raises, the exception is set on every future of the
+    batch without being logged here.
+    """
+
+    def __init__(self, name, run_batch, group_key=lambda item: None, max_batch_size=8, max_wait=0.05,
+                 max_queue_size=64, on_batch=None, batch_context=None):
+        self.name = name
+        self.on_batch = on_batch
+        self.batch_context = batch_context
+        self.run_batch = run_batch
+        self.group_key = group_key
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue_size = max_queue_size
+        self.avg_compute_time = 1.0  # EMA per batch, used for Retry-After estimates
+        # One slot per waiting request, released only when the request is taken into a batch, so
+        # requests parked in _pending (different group key) still count toward max_queue_size
+        self._slots = threading.BoundedSemaphore(max_queue_size)
+        self._queue = queue.Queue()
+        self._pending = []  # requests taken off the queue that did not fit the previous batch
+        self._thread = threading.Thread(target=self._loop, name=f'{name}-worker', daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize() + len(self._pending)
+
+    def submit(self, item):
+        future = Future()
+        future.enqueued_at = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            depth = self.depth
+            batches_ahead = math.ceil(depth / self.max_batch_size)
+            raise QueueFullError(self.name, depth, max(1, math.ceil(batches_ahead * self.avg_compute_time)))
+        self._queue.put_nowait((item, future))
+        return future
+
+    def _next_batch(self):
+        first = self._pending.pop(0) if self._pending else self._queue.get()
+        key = self.group_key(first[0])
+        batch = [first]
+
+        leftover = []
+        for entry in self._pending:
+            if len(batch) < self.max_batch_size and self.group_key(entry[0]) == key:
+                batch.append(entry)
+            else:
+                leftover.append(entry)
+        self._pending = leftover
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if self.group_key(entry[0]) == key:
+                batch.append(entry)
+            else:
+                self._pending.append(entry)
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            for _ in batch:
+                self._slots.release()
+            items = [item for item, _ in batch]
+            started_at = time.monotonic()
+            try:
+                with self.batch_context(self.name) if self.batch_context else contextlib.nullcontext():
+                    results = self.run_batch(items)
+            except Exception as e:
+                # Expected client errors (e.g. KeyError for an unknown speaker_id) also end up here;
+                # the route that waits on the future decides the status code and what to log
+                results = None
+                error = e
+            compute_time = time.monotonic() - started_at
+            self.avg_compute_time = 0.8 * self.avg_compute_time + 0.2 * compute_time
+
+            queue_times = [started_at - future.enqueued_at for _, future in batch]
+            if self.on_batch is not None:
+                try:
+                    self.on_batch(self.name, queue_times, compute_time)
+                except Exception as e:
+                    log.warning(f"[{self.name}] on_batch callback failed: {e}")
+
+            for i, (_, future) in enumerate(batch):
+                future.queue_time = queue_times[i]
+                future.compute_time = compute_time
+                if results is None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[i])
+
+
+class ModelWorker(BatchingWorker):
+    """Unbatched variant: runs submitted callables one at a time on the model's worker thread."""
+
+    def __init__(self, name, max_queue_size=64, on_batch=None, batch_context=None):
+        super().__init__(name, run_batch=lambda jobs: [jobs[0]()], max_batch_size=1, max_wait=0,
+                         max_queue_size=max_queue_size, on_batch=on_batch, batch_context=batch_context)
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(functools.partial(fn, *args, **kwargs))